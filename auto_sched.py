@@ -5,7 +5,7 @@ try:
 except:
     print("cannot load aces package...")
 
-from astropy.coordinates import AltAz, EarthLocation, SkyCoord
+from astropy.coordinates import AltAz, EarthLocation, SkyCoord, Longitude, Latitude
 from astropy.time import Time
 from astropy import units
 
@@ -13,13 +13,21 @@ import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
 
-from craco.datadirs import DataDirs, SchedDir, ScanDir, RunDir, CalDir
+from craco.datadirs import DataDirs, SchedDir, RunDir, CalDir
 from craco import plotbp
 
 from configparser import ConfigParser
+from collections import namedtuple
+from contextlib import contextmanager, ExitStack, nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import subprocess
+import threading
+import select
+import atexit
 import time
 import glob
+import pickle
+import ast
 import re
 import os
 import pdb
@@ -27,49 +35,496 @@ import pdb
 from slack_sdk import WebClient
 
 from metaflag import MetaManager
+from calstore import CalSolStore, calsol_store_path
+from uvfitsinfo import scan_first_uvfits
+import craco_cfg as cfg
 
 import logging
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-def load_config(config="database.ini", section="postgresql"):
-    parser = ConfigParser()
-    parser.read(config)
+_CONFIG_CACHE = {}
+def load_config(config="database.ini", section="postgresql", reload=False):
+    """
+    load a section from the config file, the result is cached for each (config, section)
+    """
+    key = (os.path.abspath(config), section)
+    if reload or key not in _CONFIG_CACHE:
+        parser = ConfigParser()
+        parser.read(config)
 
-    if not parser.has_section(section):
-        raise ValueError(f"Section {section} not found in {config}")
-    params = parser.items(section)
-    return {k:v for k, v in params}
+        if not parser.has_section(section):
+            raise ValueError(f"Section {section} not found in {config}")
+        params = parser.items(section)
+        _CONFIG_CACHE[key] = {k:v for k, v in params}
+    return dict(_CONFIG_CACHE[key])
 
 ### load sql
 import psycopg2
-def get_psql_connect():
-    config = load_config()
-    return psycopg2.connect(**config)
-
+from psycopg2.pool import ThreadedConnectionPool
 from sqlalchemy import create_engine 
+
+PSQL_MAXCONN = 16 # maximum number of connections in the pool
+PSQL_CHECK_INTERVAL = 60 # check whether the connection is still alive every minute
+
+_PSQL_LOCK = threading.Lock()
+_PSQL_LOCAL = threading.local() # each thread keeps one connection from the pool
+_PSQL_POOL = None
+_PSQL_ENGINE = None
+
+def _get_psql_pool():
+    global _PSQL_POOL
+    with _PSQL_LOCK:
+        if _PSQL_POOL is None or _PSQL_POOL.closed:
+            log.debug("creating database connection pool...")
+            _PSQL_POOL = ThreadedConnectionPool(0, PSQL_MAXCONN, **load_config())
+        return _PSQL_POOL
+
+def _psql_rollback_error(conn):
+    """rollback the transaction if it is aborted, so that the connection can be reused"""
+    if conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+        log.info("rolling back aborted transaction...")
+        conn.rollback()
+
+def _psql_healthy(conn):
+    """check whether the connection can still be used"""
+    if conn.closed: return False
+    try:
+        _psql_rollback_error(conn)
+        ### do not touch the connection if it is in the middle of a transaction
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return True
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error as error:
+        log.warning(f"database connection is not healthy - {error}")
+        return False
+
+def release_psql_connect(close=False):
+    """put the connection used by this thread back to the pool"""
+    conn = getattr(_PSQL_LOCAL, "conn", None)
+    _PSQL_LOCAL.conn = None
+    if conn is None: return
+    try: _get_psql_pool().putconn(conn, close=close or bool(conn.closed))
+    except Exception as error:
+        log.warning(f"failed to release database connection - {error}")
+
+@contextmanager
+def psql_thread_scope():
+    """
+    put the pooled connection used by this thread back to the pool when the work is done,
+    wrap work running in short-lived (e.g., executor) threads with it, otherwise the connection is held until the pool runs out
+    """
+    try: yield
+    finally: release_psql_connect()
+
+def get_psql_connect(pooled=True):
+    """
+    get a connection to the database
+
+    if `pooled` is True, the connection is borrowed from a process-wide pool and shared within the thread,
+    do not close it (use `release_psql_connect` or `psql_thread_scope` instead)
+    """
+    if not pooled: return psycopg2.connect(**load_config())
+
+    conn = getattr(_PSQL_LOCAL, "conn", None)
+    if conn is not None:
+        if not conn.closed and time.time() - _PSQL_LOCAL.checked < PSQL_CHECK_INTERVAL:
+            try:
+                _psql_rollback_error(conn)
+                return conn
+            except psycopg2.Error: pass
+        elif _psql_healthy(conn):
+            _PSQL_LOCAL.checked = time.time()
+            return conn
+        release_psql_connect(close=True)
+
+    pool = _get_psql_pool()
+    conn = pool.getconn()
+    if not _psql_healthy(conn): # stale connection in the pool
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    _PSQL_LOCAL.conn = conn
+    _PSQL_LOCAL.checked = time.time()
+    return conn
+
 def get_psql_engine():
-    c = load_config()
-    engine_str = "postgresql+psycopg2://"
-    engine_str += f"""{c["user"]}:{c["password"]}@{c["host"]}:{c["port"]}/{c["database"]}"""
-    return create_engine(engine_str)
+    """sqlalchemy engine, it is created once and shared in the process"""
+    global _PSQL_ENGINE
+    with _PSQL_LOCK:
+        if _PSQL_ENGINE is None:
+            c = load_config()
+            engine_str = "postgresql+psycopg2://"
+            engine_str += f"""{c["user"]}:{c["password"]}@{c["host"]}:{c["port"]}/{c["database"]}"""
+            _PSQL_ENGINE = create_engine(engine_str, pool_pre_ping=True, pool_recycle=3600)
+        return _PSQL_ENGINE
+
+@atexit.register
+def _close_psql():
+    if _PSQL_POOL is not None and not _PSQL_POOL.closed:
+        _PSQL_POOL.closeall()
+    if _PSQL_ENGINE is not None:
+        _PSQL_ENGINE.dispose()
 
 class InvalidSBIDError(Exception):
     def __init__(self, sbid):
         super().__init__(f"{sbid} is not a valid sbid")
 
+SBState = namedtuple("SBState", ["value", "name"])
+
+### ASKAP site (array centre), so that we do not need astropy sites registry
+### it is good to ~100m, which does not matter for working out elevation angles
+ASKAP_LON, ASKAP_LAT, ASKAP_HEIGHT = 116.6371, -26.6970, 377.8 # degree, degree, meter
+
+_IERS_TABLES = {}
+### astropy settings are process-wide, only one thread can be offline at a time (see `astropy_offline`)
+_ASTROPY_OFFLINE_LOCK = threading.RLock()
+def _load_offline_iers_table(iers_file=None):
+    """
+    IERS-A table from `iers_file` if it exists (see `fetch_iers_snapshot`),
+    otherwise the IERS-B table bundled with astropy, with degraded accuracy for recent times
+    tables are only loaded once
+    """
+    from astropy.utils import iers
+    if iers_file not in _IERS_TABLES:
+        if iers_file is not None and os.path.exists(iers_file):
+            log.info(f"loading IERS-A table from {iers_file}...")
+            _IERS_TABLES[iers_file] = iers.IERS_A.open(iers_file)
+        else:
+            log.warning(f"cannot find IERS-A table {iers_file}... use bundled IERS-B table instead...")
+            _IERS_TABLES[iers_file] = iers.IERS_B.open()
+    return _IERS_TABLES[iers_file]
+
+@contextmanager
+def astropy_offline(iers_file=None):
+    """
+    make sure astropy never waits on the network within this context - no sites registry and IERS table download
+    all astropy settings are restored afterwards, so that other astropy users in the process are not affected
+
+    the settings are process-wide, so the context is guarded by a lock - 
+    threads ranking field directions concurrently run one after another rather than undo each other's settings
+    """
+    from astropy.utils import iers
+    from astropy.utils import data as astropy_data
+
+    with _ASTROPY_OFFLINE_LOCK, ExitStack() as stack:
+        stack.enter_context(astropy_data.conf.set_temp("allow_internet", False))
+        stack.enter_context(iers.conf.set_temp("auto_download", False))
+        stack.enter_context(iers.conf.set_temp("auto_max_age", None))
+        if hasattr(iers.conf, "iers_degraded_accuracy"):
+            stack.enter_context(iers.conf.set_temp("iers_degraded_accuracy", "warn"))
+        stack.enter_context(iers.earth_orientation_table.set(_load_offline_iers_table(iers_file)))
+        yield
+
+def fetch_iers_snapshot(iers_file=None):
+    """
+    download the latest IERS-A table to `iers_file`, run it on a machine with internet access
+    """
+    import shutil
+    from astropy.utils import iers
+    from astropy.utils.data import download_file
+
+    if iers_file is None: iers_file = cfg.IERS_A_FILE
+    tmpfile = download_file(iers.IERS_A_URL, cache=False)
+    os.makedirs(os.path.dirname(iers_file), exist_ok=True)
+    shutil.move(tmpfile, f"{iers_file}.tmp")
+    os.replace(f"{iers_file}.tmp", iers_file)
+    log.info(f"IERS-A table saved to {iers_file}")
+
+_ASKAP_LOCATION = None
+def get_askap_location():
+    """ASKAP site location, only worked out once"""
+    global _ASKAP_LOCATION
+    if _ASKAP_LOCATION is None:
+        if cfg.ASTROPY_OFFLINE:
+            _ASKAP_LOCATION = EarthLocation.from_geodetic(
+                lon=ASKAP_LON * units.deg, lat=ASKAP_LAT * units.deg, 
+                height=ASKAP_HEIGHT * units.m,
+            )
+        else:
+            _ASKAP_LOCATION = EarthLocation.of_site("ASKAP")
+    return _ASKAP_LOCATION
+
+def rank_field_directions(
+    ra, dec, mjd=None, elev_threshold=30., gal_threshold=5., 
+    dec_range=(-80., 40.),
+):
+    """
+    vectorised calibration rank based on field directions, see `CracoSchedBlock.rank_calibration`
+
+    ra, dec - field directions in degree
+    mjd - time in the middle of the scan, nan (or None) if it is unknown
+    
+    return ranks as a numpy array
+        0 - outside RACS catalogue (dec_range), or no time information 
+        1 - elevation angle is less than `elev_threshold`, or |b| <= `gal_threshold`
+        2 - good for calibration
+    """
+    ra = np.atleast_1d(np.asarray(ra, dtype=float))
+    dec = np.atleast_1d(np.asarray(dec, dtype=float))
+    if mjd is None: mjd = np.nan
+    mjd = np.broadcast_to(np.asarray(mjd, dtype=float), ra.shape)
+
+    ranks = np.full(ra.shape, 2, dtype=int)
+    if ra.size == 0: return ranks
+    coord = SkyCoord(ra, dec, unit=units.degree)
+
+    ### galactic plane
+    ranks[np.abs(coord.galactic.b.deg) <= gal_threshold] = 1
+
+    ### elevation angle in the middle of the scan
+    inracs = (dec >= dec_range[0]) & (dec <= dec_range[1])
+    hastime = np.isfinite(mjd)
+    toaltaz = inracs & hastime
+    if toaltaz.any():
+        offline = astropy_offline(cfg.IERS_A_FILE) if cfg.ASTROPY_OFFLINE else nullcontext()
+        with offline:
+            altaz = coord[toaltaz].transform_to(AltAz(
+                obstime=Time(mjd[toaltaz], format="mjd"),
+                location=get_askap_location(),
+            ))
+        lowelev = np.zeros(ra.shape, dtype=bool)
+        lowelev[toaltaz] = altaz.alt.deg < elev_threshold
+        ranks[lowelev] = 1
+
+    ranks[~hastime] = 0
+    ranks[~inracs] = 0 # source outside RACS catalogue
+    return ranks
+
+SB_TERMINAL_STATES = ("COMPLETED", "ERRORED", "RETIRED") # state of schedule block will not change any more
+
+class SchedBlockCache:
+    """
+    on-disk cache of the scheduling block information from aces (obsparams, obsvar, state etc.)
+    one pickle file per sbid under `cachedir` (so that types of parameters are kept), 
+    the cache is refreshed if the schedule block was still running (state <= 3) when it was cached,
+    after that, parameters will not change, only the state is refreshed until it is terminal (`SB_TERMINAL_STATES`)
+    """
+    version = 2
+
+    def __init__(self, cachedir=None):
+        if cachedir is None: cachedir = cfg.SB_CACHE_DIR
+        self.cachedir = cachedir
+
+    def _cache_path(self, sbid):
+        return f"{self.cachedir}/SB{int(sbid):0>6}.pkl"
+
+    def load(self, sbid):
+        cachepath = self._cache_path(sbid)
+        if not os.path.exists(cachepath): return None
+        try:
+            with open(cachepath, "rb") as fp:
+                snapshot = pickle.load(fp)
+        except Exception as error:
+            log.warning(f"cannot load schedblock cache {cachepath} - {error}")
+            return None
+        if snapshot.get("version") != self.version: return None
+        return snapshot
+
+    def dump(self, sbid, snapshot):
+        cachepath = self._cache_path(sbid)
+        try:
+            os.makedirs(self.cachedir, exist_ok=True)
+            tmppath = f"{cachepath}.{os.getpid()}.tmp"
+            with open(tmppath, "wb") as fp:
+                pickle.dump(snapshot, fp)
+            os.replace(tmppath, cachepath)
+        except Exception as error:
+            log.warning(f"cannot write schedblock cache {cachepath} - {error}")
+
+    def fetch_state(self, sbid):
+        state = SchedulingBlock(sbid)._service.getState(sbid)
+        return dict(value=state.value, name=state.name)
+
+    _extrakeys = {
+        "template": lambda schedblock: schedblock.template,
+        "alias": lambda schedblock: schedblock.alias,
+        "footprint": lambda schedblock: schedblock.get_footprint_name(),
+    }
+
+    def _fetch_extras(self, schedblock, snapshot, keys):
+        """
+        fetch extra information (template, alias, footprint) for `keys`, 
+        keys failed to fetch are recorded in snapshot["incomplete"], so that they can be fetched again later
+        """
+        incomplete = []
+        for key in keys:
+            try: snapshot[key] = self._extrakeys[key](schedblock)
+            except Exception as error:
+                log.warning(f"cannot load {key} for {snapshot['sbid']} from aces - {error}")
+                snapshot[key] = None; incomplete.append(key)
+        snapshot["incomplete"] = incomplete
+        return snapshot
+
+    def fetch(self, sbid):
+        """
+        get the snapshot of the scheduling block from aces
+        """
+        schedblock = SchedulingBlock(sbid)
+        state = schedblock._service.getState(sbid)
+        snapshot = dict(
+            version=self.version, sbid=int(sbid), cachetime=time.time(),
+            statetime=time.time(),
+            obsparams=dict(schedblock.get_parameters()),
+            obsvar=dict(schedblock.get_variables()),
+            state=dict(value=state.value, name=state.name),
+        )
+        return self._fetch_extras(schedblock, snapshot, self._extrakeys)
+
+    def get(self, sbid, offline=False, refresh=False):
+        """
+        get the snapshot for a given sbid, 
+        if `offline` is True, only use the cache (return None if there is no cache)
+        """
+        snapshot = None if refresh else self.load(sbid)
+        if offline: return snapshot
+        if snapshot is not None and snapshot["state"]["value"] > 3: 
+            terminal = snapshot["state"]["name"] in SB_TERMINAL_STATES
+            incomplete = snapshot.get("incomplete", [])
+            if terminal and not incomplete: return snapshot
+            ### parameters are fixed after observation, but state can still change
+            try: 
+                if not terminal:
+                    snapshot["state"] = self.fetch_state(sbid)
+                    snapshot["statetime"] = time.time()
+                if incomplete: # failed last time, try again
+                    self._fetch_extras(SchedulingBlock(sbid), snapshot, incomplete)
+                self.dump(sbid, snapshot)
+            except Exception as error:
+                log.warning(f"cannot refresh schedblock information for {sbid} from aces - {error}")
+            return snapshot
+
+        try: snapshot = self.fetch(sbid)
+        except Exception as error:
+            log.warning(f"cannot load schedblock information for {sbid} from aces - {error}")
+            return snapshot
+        self.dump(sbid, snapshot)
+        return snapshot
+
+def parse_field_direction(field_direction_str):
+    """
+    parse field direction string, e.g., [12:30:00.0, -45:00:00.0, J2000] or [187.5, -45.0, J2000]
+    return ra, dec in degree
+    """
+    pattern = r"\[(.*),(.*),.*\]"
+    matched = re.findall(pattern, field_direction_str)
+    assert len(matched) == 1, f"find none or more matched pattern in {field_direction_str}"
+    ### then further parse ra and dec value
+    ra_str, dec_str = matched[0]
+    ra_str = ra_str.replace("'", "").replace('"', "").strip() # replace any possible " or '
+    dec_str = dec_str.replace("'", "").replace('"', "").strip()
+
+    if (":" in ra_str) and (":" in dec_str):
+        ra = Longitude(ra_str, unit=units.hourangle)
+    else:
+        ra = Longitude(ra_str, unit=units.degree)
+    dec = Latitude(dec_str, unit=units.degree)
+    return ra.deg, dec.deg
+
+def _literal_eval(value):
+    """evaluate python literal in the schedblock, e.g., lists and numbers"""
+    if isinstance(value, str): return ast.literal_eval(value.strip())
+    return value
+
+class SchedBlockModel:
+    """
+    structured schedule block, parsed from obsparams and obsvar in a single pass
+
+    Attributes:
+        scans: {scan: {ant: source}} for scans 0, 1, 2... (stop at the first scan without refant)
+        scan_sources: {scan: [source]}, more than one source for fly's eye mode
+        sources: all sources, in the order they appear
+        field_directions: {source: (ra, dec)} in degree, only parsed when it is first used
+    """
+    _scankey = re.compile(r"^schedblock\.scan(\d+)\.target\.(ant\d+)$")
+    _srckey = re.compile(r"^(common\.target|schedblock)\.(src\d+)\.field_direction$")
+
+    def __init__(self, obsparams, obsvar, antennas=None):
+        allscans = {}
+        directions = {"common.target": {}, "schedblock": {}}
+
+        for params in [obsparams, obsvar]:
+            for key, value in params.items():
+                matched = self._scankey.match(key)
+                if matched:
+                    scan, ant = int(matched.group(1)), matched.group(2)
+                    allscans.setdefault(scan, {})[ant] = value.strip()
+                    continue
+                matched = self._srckey.match(key)
+                if matched:
+                    directions[matched.group(1)][matched.group(2)] = value
+
+        if antennas is None: 
+            antennas = sorted(set([ant for scanants in allscans.values() for ant in scanants]))
+        self.antennas = list(antennas)
+        refant = self.antennas[0] if len(self.antennas) > 0 else None
+
+        ### only keep consecutive scans with reference antenna
+        self.scans = {}; self.scan_sources = {}; self.sources = []
+        scan = 0
+        while scan in allscans and refant in allscans[scan]:
+            scanants = allscans[scan]
+            self.scans[scan] = {ant: scanants[ant] for ant in self.antennas if ant in scanants}
+            scansrcs = []
+            for src in self.scans[scan].values():
+                if src not in scansrcs: scansrcs.append(src)
+                if src not in self.sources: self.sources.append(src)
+            if len(scansrcs) > 1: log.info(f"fly's eye mode found in scan {scan} - {scansrcs}")
+            self.scan_sources[scan] = scansrcs
+            scan += 1
+
+        ### field directions are only parsed when they are needed (see `field_directions`)
+        self._directions = directions
+        self._field_directions = None
+
+    @property
+    def field_directions(self):
+        """
+        field direction (ra, dec in degree) for each source
+        common.target.src?.field_direction in obsparams first, then schedblock.src?.field_direction
+        """
+        if self._field_directions is None:
+            field_directions = {}
+            for src in self.sources:
+                if src in self._directions["common.target"]:
+                    field_directions[src] = parse_field_direction(self._directions["common.target"][src])
+                elif src in self._directions["schedblock"]:
+                    field_directions[src] = parse_field_direction(self._directions["schedblock"][src])
+                else:
+                    raise KeyError(f"no field direction found for {src}")
+            self._field_directions = field_directions
+        return self._field_directions
+
+    @property
+    def flyseye(self):
+        return any([len(srcs) > 1 for srcs in self.scan_sources.values()])
+
 class CracoSchedBlock:
     
-    def __init__(self, sbid):
+    def __init__(self, sbid, cache=True, offline=False):
+        """
+        `cache` - use on-disk schedblock cache (see `SchedBlockCache`)
+        `offline` - only use the cache, no call to aces
+        """
         self.sbid = sbid
-        try: self.askap_schedblock = SchedulingBlock(self.sbid)
-        except: self.askap_schedblock = None
+        self.askap_schedblock = None
+        self.sbsnapshot = None
+        if cache or offline:
+            self.sbsnapshot = SchedBlockCache().get(sbid, offline=offline)
+        if self.sbsnapshot is None and not offline:
+            try: self.askap_schedblock = SchedulingBlock(self.sbid)
+            except: self.askap_schedblock = None
 
         ### craco data structure related
         self.scheddir = SchedDir(sbid=sbid)
         
         ### get obsparams and obsvar
-        if self.askap_schedblock is not None:
+        if self.sbsnapshot is not None:
+            self.obsparams = self.sbsnapshot["obsparams"]
+            self.obsvar = self.sbsnapshot["obsvar"]
+        elif self.askap_schedblock is not None:
             self.obsparams = self.askap_schedblock.get_parameters()
             self.obsvar = self.askap_schedblock.get_variables()
         
@@ -92,14 +547,10 @@ class CracoSchedBlock:
     def craco_sched_uvfits_size(self):
         """get uvfits size in total"""
         size = 0 # in the unit of GB
-        for scan in self.craco_scans:
-            try:
-                scandir = ScanDir(sbid=self.sbid, scan=scan)
-                uvfits_exists = scandir.uvfits_paths_exists
-            except:
-                continue # no rank file found... aborted
-            if len(uvfits_exists) == 0: continue
-            size += os.path.getsize(uvfits_exists[0]) / 1024 / 1024 / 1024
+        ### only the first existing beam of each scan is used
+        for first in scan_first_uvfits(self.sbid, self.craco_scans).values():
+            if first is None: continue # no rank file or no uvfits found
+            size += first[1]
         return size
 
     # get various information from aces
@@ -114,64 +565,35 @@ class CracoSchedBlock:
         else:
             self.flagants = [str(i) for i in range(1, 37) if f"ant{i}" not in self.antennas]
 
+    @property
+    def schedmodel(self):
+        """parsed schedule block, only worked out once"""
+        if getattr(self, "_schedmodel", None) is None:
+            self._schedmodel = SchedBlockModel(self.obsparams, self.obsvar, antennas=self.antennas)
+        return self._schedmodel
+
     # get source field direction
     def _get_field_direction(self, src="src1"):
-        ### first try common.target.src?.field_direction in obsparams
-        if f"common.target.{src}.field_direction" in self.obsparams:
-            field_direction_str = self.obsparams[f"common.target.{src}.field_direction"]
-        ### then try schedblock.src16.field_direction in obsvar
-        elif f"schedblock.{src}.field_direction" in self.obsvar:
-            field_direction_str = self.obsvar[f"schedblock.{src}.field_direction"]
-        return self.__parse_field_direction(field_direction_str)
-            
-    def __parse_field_direction(self, field_direction_str):
-        """parse field_direction_str"""
-        pattern = """\[(.*),(.*),.*\]"""
-        matched = re.findall(pattern, field_direction_str)
-        assert len(matched) == 1, f"find none or more matched pattern in {field_direction_str}"
-        ### then further parse ra and dec value
-        ra_str, dec_str = matched[0]
-        ra_str = ra_str.replace("'", "").replace('"', "") # replace any possible " or '
-        dec_str = dec_str.replace("'", "").replace('"', "")
-        
-        if (":" in ra_str) and (":" in dec_str):
-            field_coord = SkyCoord(ra_str, dec_str, unit=(units.hourangle, units.degree))
-        else:
-            field_coord = SkyCoord(ra_str, dec_str, unit=(units.degree, units.degree))
-            
-        return field_coord.ra.value, field_coord.dec.value
+        return self.schedmodel.field_directions[src]
     
     def get_scan_source(self):
         """
         retrieve scan and source pair based on the schedulingblock
+        for fly's eye mode, the source of the reference antenna is used, see `self.schedmodel.scan_sources` for all sources
         """
         refant = self.antennas[0]
-        scan_src_match = {}
-        sources = []
-        for scan in range(100): # assume maximum scan number is 99
-            scanstr = f"{scan:0>3}"
-            scanantkey = f"schedblock.scan{scanstr}.target.{refant}"
-            if scanantkey in self.obsvar: 
-                src = self._find_scan_source(scan)
-                scan_src_match[scan] = src
-                if src not in sources: sources.append(src)
-            else: break
-        self.scan_src_match = scan_src_match
-        self.sources = sources
+        model = self.schedmodel
+        self.scan_src_match = {scan: antsrc.get(refant, model.scan_sources[scan][0]) for scan, antsrc in model.scans.items()}
+        self.sources = list(model.sources)
             
     def _find_scan_source(self, scan):
-        # in self.obsvar under schedblock.scan000.target.ant1
-        scanstr = f"{scan:0>3}"
-        allsrc = [self.obsvar[f"schedblock.scan{scanstr}.target.{ant}"].strip() for ant in self.antennas]
-        unisrc = list(set(allsrc))
-        assert len(unisrc) == 1, "cannot handle fly's eye mode..."
-        return unisrc[0]
+        return self.schedmodel.scan_sources[scan][0]
         
     def get_sources_coord(self, ):
         """
         get source and direction pair
         """
-        self.source_coord = {src:self._get_field_direction(src) for src in self.sources}
+        self.source_coord = dict(self.schedmodel.field_directions)
 
     @property
     def corrmode(self):
@@ -180,34 +602,41 @@ class CracoSchedBlock:
         
     @property
     def template(self, ):
+        if self.sbsnapshot is not None: return self.sbsnapshot["template"]
         return self.askap_schedblock.template
       
     @property
     def spw(self, ):
         try:
             if self.template in ["OdcWeights", "Beamform"]:
-                return eval(self.obsvar["schedblock.spectral_windows"])[0]
-            return eval(self.obsvar["weights.spectral_windows"])[0]
+                return _literal_eval(self.obsvar["schedblock.spectral_windows"])[0]
+            return _literal_eval(self.obsvar["weights.spectral_windows"])[0]
         except: return [-1, -1]
         # note - schedblock.spectral_windows is the actual hardware measurement sets spw
         # i.e., for zoom mode observation, schedblock.spectral_windows one is narrower
     
     @property
     def central_freq(self, ):
-        try: return eval(self.obsparams["common.target.src%d.sky_frequency"])
+        try: return _literal_eval(self.obsparams["common.target.src%d.sky_frequency"])
         except: return -1
         
     @property
     def footprint(self, ):
+        if self.sbsnapshot is not None: 
+            if self.sbsnapshot["footprint"] is None:
+                raise ValueError(f"no footprint information cached for {self.sbid}")
+            return self.sbsnapshot["footprint"]
         return self.askap_schedblock.get_footprint_name()
     
     @property
     def status(self,):
+        if self.sbsnapshot is not None: return SBState(**self.sbsnapshot["state"])
         return self.askap_schedblock._service.getState(self.sbid)
         # return sbstatus.value, sbstatus.name
     
     @property
     def alias(self, ):
+        if self.sbsnapshot is not None: return self.sbsnapshot["alias"] or ""
         try: return self.askap_schedblock.alias
         except: return ""
     
@@ -224,7 +653,7 @@ class CracoSchedBlock:
     @property
     def duration(self, ):
         if self.status.value <= 3: return -1 # before execution
-        try: return eval(self.obsvar["executive.duration"])
+        try: return _literal_eval(self.obsvar["executive.duration"])
         except: return -1
 
     @property
@@ -281,30 +710,59 @@ class CracoSchedBlock:
             return 1
         return 2
     
-    def get_sbid_calib_rank(self, ):
-        rank = self.rank_calibration()
-        if rank != -1: return rank
-        
+    def get_rank_fields(self, ):
+        """
+        get field directions of all sources, and the time in the middle of the observation
+        return ra, dec (in degree) arrays and midmjd (nan if unknown)
+        """
         self.get_scan_source()
         self.get_sources_coord()
-        
-        ranks = []
-        ### get altaz
+
         if self.start_time > 0 and self.duration > 0:
             log.info("working out the time in the middle of the observation...")
             midmjd = self.start_time + self.duration / 86400 / 2
-            askaploc = AltAz(
-                obstime=Time(midmjd, format="mjd"),
-                location=EarthLocation.of_site("ASKAP")
-            )
-        else: askaploc=None
-        for src in self.source_coord:
-            ranks.append(
-                self.rank_calibration(self.source_coord[src], askaploc)
-            )
+        else: midmjd = np.nan
+
+        coords = np.array(list(self.source_coord.values()), dtype=float).reshape(-1, 2)
+        return coords[:, 0], coords[:, 1], midmjd
+
+    def get_scans_calib_rank(self, scans, mjds=None, **kwargs):
+        """
+        calibration rank for a list of scans (scan numbers), based on the source of the reference antenna
+        mjds - time of each scan, nan if it is unknown, the middle of the observation is used if None
+        kwargs are passed to `rank_field_directions`
+
+        return ranks as a numpy array, 0 for scans not found in the schedule block
+        """
+        rank = self.rank_calibration()
+        if rank != -1: return np.full(len(scans), rank, dtype=int)
+
+        self.get_scan_source()
+        if mjds is None: mjds = np.full(len(scans), self.get_rank_fields()[-1])
+        mjds = np.asarray(mjds, dtype=float)
         
-        if len(ranks) == 0: return 0
-        return min(ranks)
+        directions = self.schedmodel.field_directions
+        known = np.array([scan in self.scan_src_match for scan in scans], dtype=bool)
+        coords = np.array([
+            directions[self.scan_src_match[scan]] if scan in self.scan_src_match else (np.nan, np.nan) 
+            for scan in scans
+        ], dtype=float).reshape(-1, 2)
+
+        ranks = np.zeros(len(scans), dtype=int)
+        if known.any():
+            ranks[known] = rank_field_directions(coords[known, 0], coords[known, 1], mjds[known], **kwargs)
+        return ranks
+
+    def get_sbid_calib_rank(self, **kwargs):
+        """
+        kwargs are passed to `rank_field_directions`
+        """
+        rank = self.rank_calibration()
+        if rank != -1: return rank
+        
+        ra, dec, midmjd = self.get_rank_fields()
+        if len(ra) == 0: return 0
+        return int(rank_field_directions(ra, dec, midmjd, **kwargs).min())
         
     
     def format_sbid_dict(self, ):
@@ -338,7 +796,189 @@ class CracoSchedBlock:
             
         return d
 
+def get_sbids_calib_rank(sbids, offline=True, **kwargs):
+    """
+    work out calibration rank for a list of sbids, field directions of all sbids are ranked at once
+    only use schedblock cache if `offline` is True, kwargs are passed to `rank_field_directions`
+    """
+    ranks = {}
+    ras, decs, mjds, owners = [], [], [], []
+    for sbid in sbids:
+        try:
+            cracosched = CracoSchedBlock(sbid, offline=offline)
+            rank = cracosched.rank_calibration()
+            if rank != -1: 
+                ranks[sbid] = rank; continue
+            ra, dec, midmjd = cracosched.get_rank_fields()
+        except Exception as error:
+            log.warning(f"cannot get the calibration rank for {sbid}... error - {error}")
+            ranks[sbid] = -1; continue
+
+        if len(ra) == 0: 
+            ranks[sbid] = 0; continue
+        ras.append(ra); decs.append(dec)
+        mjds.append(np.full(len(ra), midmjd))
+        owners.append(np.full(len(ra), sbid))
+
+    if len(owners) == 0: return ranks
+    owners = np.concatenate(owners)
+    fieldranks = rank_field_directions(
+        np.concatenate(ras), np.concatenate(decs), np.concatenate(mjds), **kwargs
+    )
+    ### the rank of an sbid is the minimum rank of all sources
+    order = np.argsort(owners, kind="stable")
+    unisbids, starts = np.unique(owners[order], return_index=True)
+    for sbid, rank in zip(unisbids, np.minimum.reduceat(fieldranks[order], starts)):
+        ranks[sbid.item()] = int(rank)
+    return ranks
+
 ### functions to interact with database
+from psycopg2 import sql as psql
+from psycopg2.extras import execute_values
+
+# (column in the table, key in the record)
+OBSERVATION_COLUMNS = [
+    ("sbid", "sbid"), ("alias", "alias"), ("corr_mode", "corr_mode"), 
+    ("start_freq", "start_freq"), ("end_freq", "end_freq"), ("central_freq", "central_freq"), 
+    ("footprint", "footprint"), ("template", "template"), ("start_time", "start_time"), 
+    ("duration", "duration"), ("flagant", "flagant"), ("status", "status"), 
+    ("calib_rank", "calib_rank"), ("craco_record", "craco_record"), ("craco_size", "craco_size"), 
+    ("weight_reset", "weight_reset"), ("weightsched", "weight_sched"),
+]
+CALIBRATION_COLUMNS = [
+    ("sbid", "sbid"), ("valid", "valid"), ("solnum", "solnum"),
+    ("goodant", "goodant"), ("goodbeam", "goodbeam"), ("status", "status"),
+]
+
+def _to_sql_value(value):
+    """convert numpy scalar to python type so that psycopg2 can adapt it"""
+    if isinstance(value, np.generic): return value.item()
+    return value
+
+def _batch_records(records, keys, batchsize):
+    """
+    convert records (list of dictionary) to rows, only the last record is kept for duplicated keys
+    and split them into batches
+    """
+    rows = {}
+    for record in records:
+        row = tuple(_to_sql_value(record[key]) for _, key in keys)
+        rows[row[0]] = row # the first column is the key
+    rows = list(rows.values())
+    return [rows[i:i+batchsize] for i in range(0, len(rows), batchsize)]
+
+_COLUMN_TYPES = {}
+def _get_column_types(table, cur):
+    """sql type for each column in the table, worked out once for each table"""
+    if table not in _COLUMN_TYPES:
+        cur.execute(
+            """SELECT a.attname, format_type(a.atttypid, a.atttypmod) FROM pg_attribute a
+WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped""", (table, )
+        )
+        _COLUMN_TYPES[table] = dict(cur.fetchall())
+    return _COLUMN_TYPES[table]
+
+def _upsert_table(table, columns, records, conn=None, cur=None, batchsize=500):
+    """
+    insert or update records to the table, one commit for each batch
+
+    there is no unique constraint on sbid in observation and calibration tables, 
+    so `ON CONFLICT (sbid)` cannot be used - we update existing records first (`UPDATE ... FROM (VALUES ...) RETURNING`)
+    and insert the rest, the same as `upsert_execution`
+    """
+    if len(records) == 0: return
+    if conn is None: conn = get_psql_connect()
+    if cur is None: cur = conn.cursor()
+
+    colnames = [col for col, _ in columns]
+    coltypes = _get_column_types(table, cur)
+    ### values are casted to the column type, otherwise a column with all NULL is treated as text
+    template = psql.SQL("({})").format(psql.SQL(",").join([
+        psql.SQL("%s::{}").format(psql.SQL(coltypes[col])) for col in colnames
+    ])).as_string(cur)
+    update_sql = psql.SQL("""UPDATE {table} t SET {update}
+FROM (VALUES %s) AS v({cols})
+WHERE t.sbid=v.sbid
+RETURNING t.sbid""").format(
+        table=psql.Identifier(table),
+        cols=psql.SQL(",").join(map(psql.Identifier, colnames)),
+        update=psql.SQL(",").join([
+            psql.SQL("{col}=v.{col}").format(col=psql.Identifier(col)) 
+            for col in colnames if col != "sbid"
+        ])
+    ).as_string(cur)
+    insert_sql = psql.SQL("INSERT INTO {table} ({cols}) VALUES %s").format(
+        table=psql.Identifier(table),
+        cols=psql.SQL(",").join(map(psql.Identifier, colnames)),
+    ).as_string(cur)
+
+    for rows in _batch_records(records, columns, batchsize):
+        try:
+            updated = execute_values(cur, update_sql, rows, template=template, page_size=batchsize, fetch=True)
+            updated = set(sbid for sbid, in updated)
+            newrows = [row for row in rows if row[0] not in updated]
+            if len(newrows) > 0:
+                execute_values(cur, insert_sql, newrows, template=template, page_size=batchsize)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+def upsert_observation(records, conn=None, cur=None, batchsize=500):
+    """
+    push records from `CracoSchedBlock.format_sbid_dict()` to observation table
+    """
+    _upsert_table("observation", OBSERVATION_COLUMNS, records, conn=conn, cur=cur, batchsize=batchsize)
+
+def upsert_calibration(records, conn=None, cur=None, batchsize=500):
+    """
+    push records with sbid, valid, solnum, goodant, goodbeam, status to calibration table
+    """
+    _upsert_table("calibration", CALIBRATION_COLUMNS, records, conn=conn, cur=cur, batchsize=batchsize)
+
+def upsert_execution(records, conn=None, cur=None, batchsize=500):
+    """
+    push records with sbid, calsbid, scans, rawfiles, clustfiles, runname, newstatus, reset to execution table
+    
+    the status of a new record is 0, for an existing record, it is 0 if reset is True,
+    otherwise newstatus is added to the previous status. This cannot be expressed with `EXCLUDED`, 
+    so we update existing records first and insert the rest, one commit for each batch
+    """
+    if len(records) == 0: return
+    if conn is None: conn = get_psql_connect()
+    if cur is None: cur = conn.cursor()
+
+    rows = {}
+    for r in records:
+        rows[(r["sbid"], r["runname"])] = tuple(_to_sql_value(v) for v in (
+            r["sbid"], r["runname"], r["calsbid"], r["scans"], r["rawfiles"], 
+            r["clustfiles"], r.get("newstatus", 0), r.get("reset", False),
+        ))
+    rows = list(rows.values())
+
+    update_sql = """UPDATE execution e
+SET calsbid=v.calsbid, scans=v.scans, rawfiles=v.rawfiles, clustfiles=v.clustfiles,
+status=CASE WHEN v.reset THEN 0 ELSE e.status + v.newstatus END
+FROM (VALUES %s) AS v(sbid, runname, calsbid, scans, rawfiles, clustfiles, newstatus, reset)
+WHERE e.sbid=v.sbid AND e.runname=v.runname
+RETURNING e.sbid, e.runname
+"""
+    insert_sql = """INSERT INTO execution (
+    sbid, runname, calsbid, scans, rawfiles, clustfiles, status
+) VALUES %s
+"""
+    for i in range(0, len(rows), batchsize):
+        batch = rows[i:i+batchsize]
+        try:
+            updated = execute_values(cur, update_sql, batch, page_size=batchsize, fetch=True)
+            updated = set((sbid, runname) for sbid, runname in updated)
+            newrows = [row[:6] + (0, ) for row in batch if (row[0], row[1]) not in updated]
+            if len(newrows) > 0:
+                execute_values(cur, insert_sql, newrows, page_size=batchsize)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
 
 ############# FOR CALIBRATION ##################
 
@@ -348,6 +988,7 @@ def push_sbid_calibration(
     ):
     """
     add calibration information to the database
+    return `CracoCalSol` object
     """
     if int(sbid) == 0: return
     log.info(f"loading calibration for {sbid}")
@@ -392,27 +1033,11 @@ def push_sbid_calibration(
         except Exception as error:
             log.warning(f"cannot update observation table - error - {error}")
     
-    cur.execute(f"SELECT * FROM calibration WHERE SBID={sbid}")
-    res = cur.fetchall()
-    if len(res) == 0: # insert
-        insert_sql = f"""INSERT INTO calibration (
-    sbid, valid, solnum, goodant, goodbeam, status
-)
-VALUES (
-    {sbid}, {valid}, {solnum}, {goodant}, {goodbeam}, {status}
-)
-"""
-        cur.execute(insert_sql)
-        conn.commit()
-        
-    else:
-        update_sql = f"""UPDATE calibration
-SET valid={valid}, solnum={solnum}, 
-goodant={goodant}, goodbeam={goodbeam}, status={status}
-WHERE sbid={sbid}
-"""
-        cur.execute(update_sql)
-        conn.commit()
+    upsert_calibration([dict(
+        sbid=int(sbid), valid=valid, solnum=solnum, 
+        goodant=goodant, goodbeam=goodbeam, status=status,
+    )], conn=conn, cur=cur)
+    return calcls
 
 
 ################### THIS IS THE TEST CLASS FOR DEBUGGING ###################
@@ -451,8 +1076,20 @@ class CracoCalSol:
         ### load flagfreqs
         self.flagfreqs = np.loadtxt(flagfile)
 
+        ### consolidated solution written by copycal.py
+        self.store = self._load_store()
+
+    def _load_store(self):
+        fname = calsol_store_path(self.caldir.cal_head_dir)
+        if not os.path.exists(fname): return None
+        try: return CalSolStore(fname)
+        except Exception as error:
+            log.warning(f"cannot load calibration store {fname}... error - {error}")
+            return None
+
     @property
     def solnum(self):
+        if self.store is not None: return self.store.solnum
         npyfiles = glob.glob(f"{self.caldir.cal_head_dir}/??/b??.aver.4pol.smooth.npy")
         return len(npyfiles)
 
@@ -469,7 +1106,7 @@ class CracoCalSol:
         log.info(f"loading flagant of {self.sbid} from database...")
 
         engine = get_psql_engine()
-        sql_df = pd.read_sql(f"SELECT flagant FROM observation WHERE sbid={sbid}", engine)
+        sql_df = pd.read_sql(f"SELECT flagant FROM observation WHERE sbid={self.sbid}", engine)
 
         assert len(sql_df) == 1, "no sbid found in observation table..."
         flagant = sql_df["flagant"][0]
@@ -494,50 +1131,75 @@ class CracoCalSol:
         if flag: return np.where(freqflag_bool)[0]
         return np.where(~freqflag_bool)[0]
 
+    def _load_store_phase_diff(self, good_ant):
+        """
+        work out phase difference for all beams in the store at once
+        """
+        beams = self.store.beams
+        phdif, _ = calsol_phase_diff(self.store.binbp[beams, ..., 0], self.store.smobp[beams, ..., 0])
+
+        unflagchans = [self._load_flagfile_chan(self.store.freqs[ibeam], flag=False) for ibeam in beams]
+        if any([not np.array_equal(unflagchans[0], chans) for chans in unflagchans]):
+            raise ValueError("frequencies are different among beams...")
+        return beams, phdif[:, good_ant][..., unflagchans[0]]
+
+    def _load_beam_phase_diff(self, ibeam, good_ant):
+        beamcalsol = CalSolBeam(self.sbid, ibeam, store=self.store)
+        unflagchans = self._load_flagfile_chan(beamcalsol.freqs, flag=False)
+        return beamcalsol.extract_phase_diff(good_ant, unflagchans)
+
+    def load_phase_diff(self, nbeam=36, nworkers=12):
+        """
+        load calibration solutions for all beams concurrently
+
+        return beams loaded, and phase difference in a shape of (nbeam, nant, nchan)
+        """
+        good_ant = self.good_ant # only load flag antennas once
+        if self.store is not None:
+            try: return self._load_store_phase_diff(good_ant)
+            except Exception as error:
+                log.info(f"cannot load solution from calibration store for {self.sbid}... load beam by beam... error - {error}")
+
+        sbid_phase_diff = None
+        loaded = np.zeros(nbeam, dtype=bool)
+        with ThreadPoolExecutor(max_workers=nworkers) as executor:
+            futures = {
+                executor.submit(self._load_beam_phase_diff, ibeam, good_ant): ibeam 
+                for ibeam in range(nbeam)
+            }
+            for future in as_completed(futures):
+                ibeam = futures[future]
+                try:
+                    phdif = future.result()
+                    if sbid_phase_diff is None:
+                        sbid_phase_diff = np.full((nbeam, ) + phdif.shape, np.nan, dtype=phdif.dtype)
+                    sbid_phase_diff[ibeam] = phdif
+                    loaded[ibeam] = True
+                except Exception as error:
+                    log.info(f"cannot load solution from beam {ibeam} for {self.sbid}...")
+                    log.info(f"error message - {error}")
+                    continue
+
+        beams = np.where(loaded)[0]
+        if sbid_phase_diff is None:
+            raise ValueError(f"no calibration solution loaded for {self.sbid}...")
+        if len(beams) < nbeam: sbid_phase_diff = sbid_phase_diff[beams]
+        return beams, sbid_phase_diff
+
     ### calculate the score
     def rank_calsol(
         self, phase_difference_threshold=30, plot=True,
         good_frac_threshold=0.6, bad_frac_threshold=0.4,
     ):
-        beams = []; beam_phase_diff = []
-        for ibeam in range(36):
-            try:
-                beamcalsol = CalSolBeam(self.sbid, ibeam)
-                unflagchans = self._load_flagfile_chan(beamcalsol.freqs, flag=False)
-
-                phdif = beamcalsol.extract_phase_diff(self.good_ant, unflagchans)
-                beam_phase_diff.append(phdif)
-                beams.append(ibeam)
-            except Exception as error:
-                log.info(f"cannot load solution from beam {ibeam} for {self.sbid}...")
-                log.info(f"error message - {error}")
-                continue
-
-        ### concatnate things
-        sbid_phase_diff = np.concatenate(
-            [i[None, ...] for i in beam_phase_diff], axis=0
-        ) # it should be in a shape of nbeam, nant, nchan
+        beams, sbid_phase_diff = self.load_phase_diff()
+        # it should be in a shape of nbeam, nant, nchan
         self.sbid_phase_diff = sbid_phase_diff
+        self.qc_beams = beams # beam index for each of them, used for quality control plot
 
         nbeam, nant, nchan = sbid_phase_diff.shape
-        beams = np.array(beams)
         if plot: ### plot phase differencec image for all beams
             log.info(f"plotting calibration solution quality control plot for SB{self.sbid}")
-            fig = plt.figure(figsize=(12, 8), facecolor="white", dpi=75)
-            for i in range(36):
-                ax = fig.add_subplot(6, 6, i+1)
-                ax.set_title(f"beam{i:0>2}")
-                try: index = np.where(beams==i)[0][0]
-                except: 
-                    log.info(f"no solution loaded from beam{i}... will not plot it")
-                    continue
-                ax.imshow(
-                    sbid_phase_diff[index], vmin=0, vmax=90, 
-                    aspect="auto", interpolation="none"
-                )
-            fig.tight_layout()
-            fig.savefig(f"{self.caldir.cal_head_dir}/calsol_qc.png", bbox_inches="tight")
-            plt.close()
+            render_calsol_qc(sbid_phase_diff, beams, f"{self.caldir.cal_head_dir}/calsol_qc.png")
 
         ### work out statistics
         sbid_phase_good = sbid_phase_diff < phase_difference_threshold
@@ -555,10 +1217,103 @@ class CracoCalSol:
 
         return valid_calsol, good_ant_count, good_beam_count
         
+def render_calsol_qc(
+    sbid_phase_diff, beams, fname, nbeam=36, ncol=6, 
+    vmin=0, vmax=90, cmap="viridis", rowscale=4, gap=4, labelh=16,
+):
+    """
+    render phase difference of all beams as a single composite image with a label on top of each beam,
+    beams are tiled from the top left (beam 0) with `ncol` beams per row, missing beams are left blank
+
+    sbid_phase_diff - (nbeam loaded, nant, nchan), beams - beam index for each of them
+    rowscale - repeat each antenna `rowscale` times so that the image is not too flat
+    labelh - height of the label above each beam in pixels
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    _, nant, nchan = sbid_phase_diff.shape
+    nrow = int(np.ceil(nbeam / ncol))
+    tileh, tilew = labelh + nant * rowscale + gap, nchan + gap
+
+    composite = np.full((nrow * tileh, ncol * tilew), np.nan, dtype=np.float32)
+    for index, ibeam in enumerate(beams):
+        irow, icol = divmod(int(ibeam), ncol)
+        y0, x0 = irow * tileh + labelh, icol * tilew
+        composite[y0:y0 + nant*rowscale, x0:x0 + nchan] = np.repeat(sbid_phase_diff[index], rowscale, axis=0)
+
+    normed = np.clip(np.nan_to_num((composite - vmin) / (vmax - vmin)), 0, 1)
+    rgba = plt.get_cmap(cmap)(normed)
+    rgba[np.isnan(composite)] = 1. # gaps, labels and missing beams in white
+
+    ### one pixel in the image is one pixel in the figure
+    dpi = 100
+    height, width = composite.shape
+    fig = Figure(figsize=(width / dpi, height / dpi), dpi=dpi, facecolor="white")
+    FigureCanvasAgg(fig)
+    fig.figimage(rgba, xo=0, yo=0, origin="upper")
+    loaded = set(int(ibeam) for ibeam in beams)
+    for ibeam in range(nbeam):
+        irow, icol = divmod(ibeam, ncol)
+        label = f"beam{ibeam:0>2}" if ibeam in loaded else f"beam{ibeam:0>2} (missing)"
+        fig.text(
+            (icol * tilew + 2) / width, 1 - (irow * tileh + 1) / height, label,
+            ha="left", va="top", fontsize=labelh * 0.5, color="black",
+        )
+    fig.savefig(fname, dpi=dpi, facecolor="white")
+    log.info(f"quality control plot saved to {fname}")
+    return fname
+
+CALSOL_POLS = {"XX": 0, "XY": 1, "YX": 2, "YY": 3}
+
+def calsol_phase_diff(binbp, smobp, out=None):
+    """
+    wrapped phase difference (in degree, between 0 and 180) between binary and smooth bandpass,
+    after referencing both of them to the antenna with the least invalid channels
+
+    binbp, smobp - complex bandpass in a shape of (..., nant, nchan), e.g., (nbeam, npol, nant, nchan)
+    out - float array in a shape of (..., nant, nchan) to store the result, allocate one if None
+
+    return phase difference and reference antenna (0-indexed) in a shape of (...)
+    """
+    binbp = np.asarray(binbp); smobp = np.asarray(smobp)
+
+    ### reference antenna - the one with the least nan/inf values
+    nanfrac = (~np.isfinite(binbp)).mean(axis=-1)
+    refant = nanfrac.argmin(axis=-1)
+    if np.any(np.take_along_axis(nanfrac, refant[..., None], axis=-1) == 1.):
+        raise ValueError("no reference antenna found...")
+
+    ### the phase of smo * conj(bin) is smoph - binph, then remove the phase of reference antenna
+    z = np.conjugate(binbp)
+    z *= smobp
+    zref = np.take_along_axis(z, refant[..., None, None], axis=-2)
+    np.conjugate(zref, out=zref)
+    z *= zref
+
+    if out is None: out = np.empty(z.shape, dtype=z.real.dtype)
+    np.arctan2(z.imag, z.real, out=out)
+    np.abs(out, out=out)
+    np.degrees(out, out=out)
+    return out, refant
+
 class CalSolBeam:
-    def __init__(self, sbid, beam,):
+    def __init__(self, sbid, beam, pol=0, store=None):
+        """
+        pol - polarisation(s) to load, either index or name (0/XX, 1/XY, 2/YX, 3/YY)
+            bandpass and phase difference are in a shape of (nant, nchan) for a single polarisation,
+            (npol, nant, nchan) for a list of polarisations
+        store - `CalSolStore`, read solution from it instead of the files for each beam
+        """
         self.sbid = sbid
+        self.beam = beam
         self.caldir = CalDir(sbid)
+        if store is not None and not store.valid[beam]: store = None
+        self.store = store
+
+        self.multipol = isinstance(pol, (list, tuple))
+        if not self.multipol: pol = [pol]
+        self.pols = [CALSOL_POLS[p] if isinstance(p, str) else int(p) for p in pol]
 
         ### all files
         self.binfile = self.caldir.beam_cal_binfile(beam)
@@ -568,6 +1323,7 @@ class CalSolBeam:
 
     @property
     def freqs(self,):
+        if self.store is not None: return self.store.freqs[self.beam]
         try:
             return np.load(self.freqfile)
         except:
@@ -575,42 +1331,27 @@ class CalSolBeam:
             return None
 
     def __load_bandpass(self,):
-        ### load bin bandpass
-        log.warning("only XX calibration solution is loaded...")
-        bpcls = plotbp.Bandpass.load(self.binfile)
-        self.binbp = bpcls.bandpass.copy()[0, ..., 0]
-        nant, nchan = self.binbp.shape
-        ### load smooth bandpass
-        self.smobp = np.load(self.smoothfile)[0, ..., 0]
-
-        ### find reference antenna based on self.binbp
-        valid_data_arr = np.array([self.__count_nan(self.binbp[ia]) for ia in range(nant)])
-        ira = valid_data_arr.argmin() # reference antenna, 0-indexed
-        assert valid_data_arr[ira] != 1., f"no reference antenna found for {self.binfile}"
-        log.info(f"use {ira} (0-indexed) as the reference antenna")
-
-        ### workout phase
-        self.binph = np.angle(self.binbp / self.binbp[ira], deg=True)
-        self.smoph = np.angle(self.smobp / self.smobp[ira], deg=True)
-
-        self.phdif = np.min([
-            (self.smoph - self.binph) % 360, (self.binph - self.smoph) % 360
-        ], axis=0)
-
-    def __count_nan(self, arr, isnan=True, fraction=True):
-        total = np.size(arr)
-        nancount = (np.isnan(arr) | np.isinf(arr)).sum()
-        if fraction:
-            if isnan: return nancount / total
-            return 1 - nancount / total
-        if isnan: return nancount
-        return total - nancount
+        ### load bin and smooth bandpass - (nant, nchan, npol) -> (npol, nant, nchan)
+        if self.store is not None:
+            binbp = self.store.binbp[self.beam]
+            smobp = self.store.smobp[self.beam]
+        else:
+            binbp = plotbp.Bandpass.load(self.binfile).bandpass[0]
+            smobp = np.load(self.smoothfile, mmap_mode="r")[0]
+        self.binbp = np.moveaxis(binbp[..., self.pols], -1, 0)
+        self.smobp = np.moveaxis(smobp[..., self.pols], -1, 0)
+
+        self.phdif, self.refant = calsol_phase_diff(self.binbp, self.smobp)
+        log.info(f"use {self.refant} (0-indexed) as the reference antenna for polarisation {self.pols}")
+
+        if not self.multipol:
+            self.binbp, self.smobp, self.phdif = self.binbp[0], self.smobp[0], self.phdif[0]
 
     def extract_phase_diff(self, goodant=None, unflagchan=None):
         if goodant is None: goodant = np.arange(30)
         ### only select data known to be good
-        phdif = self.phdif[goodant]
-        if unflagchan is not None:  phdif = phdif[:, unflagchan]
+        phdif = self.phdif[..., goodant, :]
+        if unflagchan is not None:  phdif = phdif[..., unflagchan]
         return phdif
 
 ########### FOR execution ###############
@@ -642,37 +1383,11 @@ def push_sbid_execution(
             continue
             
     ### start to update database
-    if conn is None: conn = get_psql_connect()
-    if cur is None: cur = conn.cursor()
-    cur.execute(f"SELECT sbid, status FROM execution WHERE SBID={sbid} AND RUNNAME='{runname}'")
-    
-    res = cur.fetchall()
-    if len(res) == 0: # insert
-        status = 0 # set the original status to 0
-        insert_sql = f"""INSERT INTO execution (
-    sbid, calsbid, status, scans, rawfiles, clustfiles, runname
-)
-VALUES (
-    {sbid}, {calsbid}, {status}, {scans}, {rawfile_count}, {clusfile_count}, '{runname}'
-)
-"""
-        cur.execute(insert_sql)
-        conn.commit()
-        
-    else:
-        ### if reset is True, you need to set status to 0
-        if reset: status = 0
-        else:
-            previous_status = res[0][1]
-            status = previous_status + newstatus
-        
-        update_sql = f"""UPDATE execution
-SET calsbid={calsbid}, status={status}, scans={scans}, 
-rawfiles={rawfile_count}, clustfiles={clusfile_count}
-WHERE sbid={sbid} AND runname='{runname}'
-"""
-        cur.execute(update_sql)
-        conn.commit()
+    upsert_execution([dict(
+        sbid=int(sbid), runname=runname, calsbid=calsbid, scans=scans,
+        rawfiles=rawfile_count, clustfiles=clusfile_count, 
+        newstatus=newstatus, reset=reset,
+    )], conn=conn, cur=cur)
 
 
 #### function to pick up correct calibration
@@ -703,6 +1418,110 @@ def check_calib_flagant(calflagant, obsflagant):
     if len(calflagant - obsflagant) == 0: return True
     return False
 
+def check_calib_flagant_batch(calflagants, obsflagants):
+    """
+    vectorised version of `check_calib_flagant`
+    `calflagants` and `obsflagants` are arrays of flagant string with the same length
+
+    return a boolean array, True if the calibration is suitable for the observation
+    """
+    calflagants = np.asarray(calflagants, dtype=object)
+    obsflagants = np.asarray(obsflagants, dtype=object)
+    
+    ### parse each unique flagant string only once
+    uniflagants, inverse = np.unique(
+        np.concatenate([calflagants, obsflagants]).astype(str), return_inverse=True
+    )
+    unilsts = [_flagant_str_to_lst(flagant) for flagant in uniflagants]
+    univalid = np.array([lst is not None for lst in unilsts], dtype=bool)
+    maxant = max([max(lst) for lst in unilsts if lst] + [36])
+    unimask = np.zeros((len(uniflagants), maxant + 1), dtype=bool)
+    for i, lst in enumerate(unilsts):
+        if lst: unimask[i, lst] = True
+
+    ncal = len(calflagants)
+    calidx, obsidx = inverse[:ncal], inverse[ncal:]
+    if not np.all(univalid[obsidx]):
+        log.warning("flagant info for some observation sbid is missing...")
+
+    ### if there is any calflagant *NOT* in obsflagant, then it is not suitable
+    extraflag = (unimask[calidx] & ~unimask[obsidx]).any(axis=1)
+    return univalid[calidx] & univalid[obsidx] & ~extraflag
+
+class BatchCalFinder:
+    """
+    find calibration for a list of sbids with a single windowed join,
+    it gives the same answer as running `CalFinder` for each sbid
+    """
+    def __init__(self, sbids, conn=None, cur=None):
+        self.sbids = [int(sbid) for sbid in sbids]
+
+        if conn is None: conn = get_psql_connect()
+        if cur is None: cur = conn.cursor()
+        self.conn = conn
+        self.cur = cur
+
+    def _query_candidates(self, timethreshold=1.5):
+        """
+        get all potential calibration sbids for all sbids in one query
+        """
+        columns = [
+            "obssbid", "obsflagant", "calsbid", "calflagant", "calib_rank", 
+            "delete", "craco_size", "valid", "solnum", "calstatus",
+        ]
+        if len(self.sbids) == 0: return pd.DataFrame(columns=columns)
+
+        joinsql = f"""SELECT o.sbid,o.flagant,c.sbid,c.flagant,c.calib_rank,c.delete,c.craco_size,cal.valid,cal.solnum,cal.status
+FROM observation o JOIN observation c
+ON c.weightsched=o.weightsched AND c.central_freq=o.central_freq AND c.footprint=o.footprint
+AND c.start_time>=o.start_time-{timethreshold} AND c.start_time<=o.start_time+{timethreshold}
+LEFT JOIN calibration cal ON cal.sbid=c.sbid
+WHERE o.sbid IN ({",".join([str(sbid) for sbid in self.sbids])})
+AND (
+    (cal.valid=True AND cal.solnum=36 AND cal.status=0) OR cal.status=1
+    OR (c.calib_rank>=1 AND c.delete=False AND c.craco_size>0)
+)
+"""
+        self.cur.execute(joinsql)
+        df = pd.DataFrame(self.cur.fetchall(), columns=columns)
+        for col in ["calib_rank", "craco_size", "solnum", "calstatus"]:
+            df[col] = pd.to_numeric(df[col]) # NULL from the left join will be NaN
+        return df
+
+    def query(self, timethreshold=1.5):
+        """
+        return a dictionary with sbid as the key, and (calsbid, calstatus, newcalsbid) as the value
+            calsbid, calstatus - the same as `CalFinder.query_calib_table`
+            newcalsbid - the same as `CalFinder.query_observe_table`, only worked out if calsbid is None
+        """
+        result = {sbid: (None, None, None) for sbid in self.sbids}
+
+        df = self._query_candidates(timethreshold=timethreshold)
+        log.info(f"{len(df)} calibration candidates found in the database for {len(self.sbids)} sbids...")
+        if len(df) == 0: return result
+
+        flagcheck = check_calib_flagant_batch(df["calflagant"].values, df["obsflagant"].values)
+        calmask = (
+            ((df["valid"] == True) & (df["solnum"] == 36) & (df["calstatus"] == 0)) | (df["calstatus"] == 1)
+        ).values & flagcheck
+        obsmask = (
+            (df["calib_rank"] >= 1) & (df["delete"] == False) & (df["craco_size"] > 0)
+        ).values & flagcheck
+
+        ### existing calibration - pick the most recent one
+        caldf = df[calmask].sort_values(["obssbid", "calsbid"], ascending=[True, False])
+        for _, row in caldf.drop_duplicates("obssbid", keep="first").iterrows():
+            result[int(row["obssbid"])] = (int(row["calsbid"]), int(row["calstatus"]), None)
+
+        ### potential calibration - pick the one with the highest rank
+        obsdf = df[obsmask].sort_values(["obssbid", "calib_rank", "calsbid"], ascending=[True, False, False])
+        for _, row in obsdf.drop_duplicates("obssbid", keep="first").iterrows():
+            obssbid = int(row["obssbid"])
+            if result[obssbid][0] is not None: continue
+            result[obssbid] = (None, None, int(row["calsbid"]))
+
+        return result
+
 class CalFinder:
     def __init__(self, sbid):
         self.sbid = sbid
@@ -766,48 +1585,12 @@ ORDER BY calib_rank DESC, SBID DESC
 
 ######## initial update to the observation database #######
 def _update_craco_sched_status(craco_sched_info, conn=None, cur=None):
-    if conn is None: conn = get_psql_connect()
-    if cur is None: cur = conn.cursor()
+    upsert_observation([craco_sched_info], conn=conn, cur=cur)
 
-    sbid = craco_sched_info["sbid"]
-    # find whether this sbid exists already
-    cur.execute(f"SELECT * FROM observation WHERE SBID = {sbid}")
-    res = cur.fetchall()
-    if len(res) == 0: # insert
-        d = craco_sched_info
-        insert_sql = f"""INSERT INTO observation (
-    sbid, alias, corr_mode, start_freq, end_freq, 
-    central_freq, footprint, template, start_time, 
-    duration, flagant, status, calib_rank, craco_record, 
-    craco_size, weight_reset, weightsched
-)
-VALUES (
-    {d["sbid"]}, '{d["alias"]}', '{d["corr_mode"]}', {d["start_freq"]}, {d["end_freq"]},
-    {d["central_freq"]}, '{d["footprint"]}', '{d["template"]}', {d["start_time"]},
-    {d["duration"]}, '{d["flagant"]}', {d["status"]}, {d["calib_rank"]}, {d["craco_record"]}, 
-    {d["craco_size"]}, {d["weight_reset"]}, {d["weight_sched"]}
-);
-"""
-        cur.execute(insert_sql)
-        conn.commit()
-        
-    else: # update
-        d = craco_sched_info
-        update_sql = f"""UPDATE observation 
-SET alias='{d["alias"]}', corr_mode='{d["corr_mode"]}', start_freq={d["start_freq"]},
-end_freq={d["end_freq"]}, central_freq={d["central_freq"]}, footprint='{d["footprint"]}', 
-template='{d["template"]}', start_time={d["start_time"]}, duration={d["duration"]}, 
-flagant='{d["flagant"]}', status={d["status"]}, calib_rank={d["calib_rank"]}, 
-craco_record={d["craco_record"]}, craco_size={d["craco_size"]}, 
-weight_reset={d["weight_reset"]}, weightsched={d["weight_sched"]}
-WHERE sbid={sbid}
-"""
-        cur.execute(update_sql)
-        conn.commit()
-
-
-def push_sbid_observation(sbid, conn=None, cur=None):
-    log.info(f"updating observation database for {sbid}...")
+def get_sbid_observation_dict(sbid):
+    """
+    get the record to be pushed to observation table for a given sbid
+    """
     try:
         cracosched = CracoSchedBlock(sbid)
         d = cracosched.format_sbid_dict()
@@ -821,12 +1604,35 @@ def push_sbid_observation(sbid, conn=None, cur=None):
             status=-1, calib_rank=-1, craco_size=-1,
             weight_sched=-1, weight_reset=False
         )
+    return d
+
+def push_sbid_observation(sbid, conn=None, cur=None):
+    log.info(f"updating observation database for {sbid}...")
+    d = get_sbid_observation_dict(sbid)
 
     try:
         _update_craco_sched_status(craco_sched_info=d, conn=conn, cur=cur)
     except Exception as error:
         log.critical(f"failed to push schedblock status for {sbid}... please check... \n error - {error}")
 
+def push_sbids_observation(records, conn=None, cur=None, batchsize=500):
+    """
+    push a list of records from `get_sbid_observation_dict` in batches
+    """
+    if len(records) == 0: return
+    log.info(f"updating observation database for {len(records)} sbids...")
+    try:
+        upsert_observation(records, conn=conn, cur=cur, batchsize=batchsize)
+        return
+    except Exception as error:
+        log.warning(f"failed to push schedblock status in batch... push them one by one... error - {error}")
+
+    for d in records:
+        try:
+            _update_craco_sched_status(craco_sched_info=d, conn=conn, cur=cur)
+        except Exception as error:
+            log.critical(f"failed to push schedblock status for {d['sbid']}... please check... \n error - {error}")
+
 ######### function to update observation #######
 def get_db_max_sbid(conn=None, cur=None):
     if conn is None: conn = get_psql_connect()
@@ -837,13 +1643,55 @@ def get_db_max_sbid(conn=None, cur=None):
 
     return maxsbid
 
+def _remove_metafile(metamanager):
+    metapath = f"{metamanager.workdir}/{metamanager.metaname}"
+    try: os.remove(metapath)
+    except FileNotFoundError: pass
+    except Exception as error:
+        log.warning(f"cannot remove {metapath} - {error}")
+
+def _ingest_sbid(sbid, waittime=60, maxtry=3):
+    """
+    load metadata and get the observation record for a given sbid
+    retry with exponential backoff (waittime, 2*waittime, 4*waittime...) if anything goes wrong
+    """
+    log.info(f"updating sbid - {sbid}")
+    for i in range(maxtry):
+        metamanager = MetaManager(sbid, stream=cfg.STREAM_METADATA)
+        try:
+            metamanager.run(skadi=False)
+            return get_sbid_observation_dict(sbid)
+        except EOFError:
+            log.info(f"copy metadata unsuccessfully for {sbid}... deleting and rerun - tried {i+1}")
+        except Exception as error:
+            log.info(f"something goes wrong for the metadata of {sbid}... deleting and rerun - tried {i+1} - error {error}")
+        _remove_metafile(metamanager)
+        if i < maxtry - 1: time.sleep(waittime * 2 ** i)
+
+    log.error(f"cannot load metadata from tethys for {sbid}... use skadi one instead...")
+    try:
+        metamanager = MetaManager(sbid, stream=cfg.STREAM_METADATA)
+        metamanager.run(skadi=True)
+    except Exception as error:
+        log.info(f"cannot load metadata from skadi for {sbid}... push the database anyway...")
+    return get_sbid_observation_dict(sbid)
+
+def _ingest_sbid_worker(sbid, **kwargs):
+    """`_ingest_sbid` in a worker thread, database connection is released afterwards"""
+    with psql_thread_scope():
+        return _ingest_sbid(sbid, **kwargs)
+
 def run_observation_update(
     latestsbid, defaultsbid=None, waittime=60, 
-    maxtry=3
+    maxtry=3, batchsize=50, nworkers=8,
 ):
     """
     based on the latest sbid, update the observation table
     this can be used in sbrunner
+
+    sbids are ingested by `nworkers` workers concurrently, 
+    but records are pushed to the database in the order of sbid (every `batchsize` sbids),
+    so that the maximum sbid in the database is always a safe point to restart from
     """
     # get maximum sbid in the database first
     conn = get_psql_connect()
@@ -859,34 +1707,141 @@ def run_observation_update(
         log.info(f"will use {defaultsbid} to as maximum sbid to update database...")
     log.info(f"previous maximum sbid found in database is - {maxsbid}")
 
-    for sbid in range(maxsbid+1, latestsbid+1):
-        ### run meta data loader here
-        log.info(f"updating sbid - {sbid}")
-        success = False
-        for i in range(maxtry):
-            try:
-                metamanager = MetaManager(sbid)
-                metamanager.run(skadi=False)
-                push_sbid_observation(sbid, conn=conn, cur=cur)
-                success = True
-                break
-            except EOFError:
-                log.info(f"copy metadata unsuccessfully... deleting and rerun - tried {i+1}")
-                os.system(f"rm {metamanager.workdir}/{metamanager.metaname}")
-                time.sleep(waittime)
-            except Exception as error:
-                log.info(f"something goes wrong for this metadata... deleting and rerun - tried {i+1}")
-                os.system(f"rm {metamanager.workdir}/{metamanager.metaname}")
-                time.sleep(waittime)
-        if not success:
-            log.error(f"cannot load metadata from tethys for {sbid}... use skadi one instead...")
-            try:
-                metamanager = MetaManager(sbid)
-                metamanager.run(skadi=True)
+    sbids = list(range(maxsbid+1, latestsbid+1))
+    if len(sbids) == 0: return
+
+    finished = {} # sbid - record, waiting to be pushed
+    records = []; inext = 0
+    with ThreadPoolExecutor(max_workers=nworkers) as executor:
+        futures = {
+            executor.submit(_ingest_sbid_worker, sbid, waittime=waittime, maxtry=maxtry): sbid 
+            for sbid in sbids
+        }
+        for future in as_completed(futures):
+            sbid = futures[future]
+            try: finished[sbid] = future.result()
             except Exception as error:
-                log.info("cannot load metadata from skadi... push the database anyway...")
-            push_sbid_observation(sbid, conn=conn, cur=cur)
+                log.critical(f"failed to ingest {sbid}... error - {error}")
+                finished[sbid] = get_sbid_observation_dict(sbid)
+
+            ### only push sbids in order
+            while inext < len(sbids) and sbids[inext] in finished:
+                records.append(finished.pop(sbids[inext]))
+                inext += 1
+            if len(records) >= batchsize:
+                push_sbids_observation(records, conn=conn, cur=cur, batchsize=batchsize)
+                records = []
+    push_sbids_observation(records, conn=conn, cur=cur, batchsize=batchsize)
+
+
+### event driven scheduling - notification from database and metadata directory
+SCHED_NOTIFY_CHANNEL = "craco_sched"
 
+def install_sched_notify(conn=None, cur=None, channel=SCHED_NOTIFY_CHANNEL):
+    """
+    install triggers on observation and calibration table
+    every insert/update will send `<table>:<sbid>` to the notification channel
+    """
+    if conn is None: conn = get_psql_connect()
+    if cur is None: cur = conn.cursor()
+
+    funcsql = f"""CREATE OR REPLACE FUNCTION craco_sched_notify() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('{channel}', TG_TABLE_NAME || ':' || NEW.sbid);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+"""
+    cur.execute(funcsql)
+    for table in ["observation", "calibration"]:
+        cur.execute(f"DROP TRIGGER IF EXISTS {table}_sched_notify ON {table}")
+        cur.execute(f"""CREATE TRIGGER {table}_sched_notify
+AFTER INSERT OR UPDATE ON {table}
+FOR EACH ROW EXECUTE PROCEDURE craco_sched_notify()
+""")
+    conn.commit()
+
+class SchedEventListener:
+    """
+    wait for changes in the database (LISTEN/NOTIFY), 
+    and use metadata directory as a fallback (i.e., new metadata file landed)
+
+    events are returned as a dictionary - {"observation": set(), "calibration": set(), "metadata": set()}
+    """
+    def __init__(
+        self, channel=SCHED_NOTIFY_CHANNEL, 
+        metadir="/CRACO/DATA_00/craco/metadata",
+    ):
+        self.channel = channel
+        self.metadir = metadir
+        self.conn = None
+        self._listen()
+        self._metamtime = None
+        self._metasnap = self._snapshot_metadir()
+
+    def _listen(self):
+        """open a dedicated connection for LISTEN - it needs to be autocommit"""
+        try:
+            if self.conn is not None: self.conn.close()
+        except: pass
+        self.conn = get_psql_connect(pooled=False)
+        self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        self.conn.cursor().execute(f"LISTEN {self.channel};")
+        log.info(f"listening to database notification on {self.channel}...")
+
+    def _snapshot_metadir(self):
+        try:
+            return {
+                entry.name: entry.stat().st_mtime for entry in os.scandir(self.metadir)
+                if entry.name.startswith("SB") and entry.name.endswith(".json.gz")
+            }
+        except Exception as error:
+            log.warning(f"cannot scan metadata directory {self.metadir} - {error}")
+            return {}
+
+    def _poll_metadir(self):
+        """get sbids with new or modified metadata files"""
+        ### only scan the whole directory if something changed in it
+        try: metamtime = os.stat(self.metadir).st_mtime
+        except: metamtime = None
+        if metamtime is not None and metamtime == self._metamtime: return set()
+        self._metamtime = metamtime
+
+        snap = self._snapshot_metadir()
+        changed = [name for name, mtime in snap.items() if self._metasnap.get(name) != mtime]
+        self._metasnap = snap
+
+        sbids = set()
+        for name in changed:
+            try: sbids.add(int(name[2:].split(".")[0]))
+            except: log.warning(f"cannot get sbid from metadata file {name}")
+        return sbids
+
+    def _poll_notify(self, timeout):
+        events = {"observation": set(), "calibration": set()}
+        try:
+            if select.select([self.conn], [], [], timeout) != ([], [], []):
+                self.conn.poll()
+                while self.conn.notifies:
+                    notify = self.conn.notifies.pop(0)
+                    try:
+                        table, sbid = notify.payload.split(":")
+                        events[table].add(int(sbid))
+                    except Exception as error:
+                        log.warning(f"cannot parse notification {notify.payload} - {error}")
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as error:
+            log.warning(f"lost listening connection - {error}... reconnecting...")
+            time.sleep(timeout)
+            self._listen()
+        return events
+
+    def wait(self, timeout=1.):
+        """
+        wait for events for up to `timeout` seconds
+        """
+        events = self._poll_notify(timeout)
+        events["metadata"] = self._poll_metadir()
+        return events
 
 ### auto scheduling related - how to schedule all different stuff...
 class PipeSched:
@@ -900,34 +1855,75 @@ class PipeSched:
 
         self.slackbot = SlackPostManager(test=test)
 
-    def _query_nonrun_sbid(self):
+    def _query_nonrun_sbid(self, sbids=None):
         """
         query sbid need to be queued...
+        if `sbids` is provided, only check those sbids
         """
         sql = f"""SELECT sbid FROM observation
 WHERE tsp=false AND delete=false AND weight_reset=false
 AND craco_record=true AND status > 3
-ORDER BY sbid ASC
-""" # status need to be double checked!
+"""
+        if sbids is not None:
+            if len(sbids) == 0: return []
+            sql += f"""AND sbid IN ({",".join([str(int(i)) for i in sbids])})\n"""
+        sql += "ORDER BY sbid ASC" # status need to be double checked!
         
         self.cur.execute(sql)
         res = self.cur.fetchall()
 
         if len(res) == 0: return []
         return [i[0] for i in res]
+
+    def _query_calib_dependent_sbid(self, calsbids, timethreshold=1.5):
+        """
+        query sbid need to be queued that may use any of `calsbids` as calibration
+        """
+        if len(calsbids) == 0: return []
+        sql = f"""SELECT DISTINCT o.sbid FROM observation o JOIN observation c
+ON o.weightsched=c.weightsched AND o.central_freq=c.central_freq AND o.footprint=c.footprint
+AND o.start_time>=c.start_time-{timethreshold} AND o.start_time<=c.start_time+{timethreshold}
+WHERE c.sbid IN ({",".join([str(int(i)) for i in calsbids])})
+AND o.tsp=false AND o.delete=false AND o.weight_reset=false
+AND o.craco_record=true AND o.status > 3
+ORDER BY o.sbid ASC
+"""
+        self.cur.execute(sql)
+        res = self.cur.fetchall()
+        return [i[0] for i in res]
+
+    def _query_event_sbid(self, events, timethreshold=1.5):
+        """
+        work out sbids to be re-evaluated based on events from SchedEventListener
+        """
+        sbids = set(self._query_nonrun_sbid(events["observation"] | events["metadata"]))
+        ### a new observation may also be the calibrator that older sbids are waiting for
+        sbids |= set(self._query_calib_dependent_sbid(
+            events["calibration"] | events["observation"], timethreshold=timethreshold
+        ))
+        return sorted(sbids)
     
 
-    def _sbid_run(self, sbid, timethreshold=1.5, post=False):
+    def _sbid_run(self, sbid, timethreshold=1.5, post=False, calinfo=None):
         """
         run a given sbid - either run prepare_skadi, or run run_calib or wait
+        `calinfo` is (calsbid, calstatus, newcalsbid) from `BatchCalFinder`, query database if it is None
+
+        return the calibration sbid if a new calibration is scheduled
         """
-        calfinder = CalFinder(sbid)
-        #pdb.set_trace()
-        calsbid, calstatus = calfinder.query_calib_table(timethreshold=timethreshold)
+        if calinfo is None:
+            calfinder = CalFinder(sbid)
+            calsbid, calstatus = calfinder.query_calib_table(timethreshold=timethreshold)
+            newcalsbid = None
+            if calsbid is None:
+                newcalsbid = calfinder.query_observe_table(timethreshold=timethreshold)
+        else:
+            calsbid, calstatus, newcalsbid = calinfo
+
         if calsbid is None:
             #pdb.set_trace()
             log.info(f"cannot find existing sbid for calibration for {sbid}... will create a new one")
-            calsbid = calfinder.query_observe_table(timethreshold=timethreshold)
+            calsbid = newcalsbid
             if calsbid is None:
                 log.warning(f"no calibration found for {sbid}... will wait for further observation...")
                 if post:
@@ -939,7 +1935,7 @@ ORDER BY sbid ASC
             ### now it is time to schedule calibration run...
             log.info("scheduling calibration...")
             self._run_calib(calsbid=calsbid)
-            return
+            return calsbid
             
         if calstatus == 1: # calibration is running now
             log.info(f"calibration for {sbid} - {calsbid} is still running... wait for it to finish...")
@@ -995,19 +1991,68 @@ ORDER BY sbid ASC
         # subprocess.run([runcmd], shell=True, capture_output=True, text=True, env=envs)
         self._subprocess_execute(runcmd, envs=envs, post=True)
 
-    def run(self, timethreshold=1.):
+    def _run_sbids(self, sbid_to_run, timethreshold=1.):
+        log.info(f"found {len(sbid_to_run)} schedule blocks to be processed...")
+        if len(sbid_to_run) == 0: return
+
+        ### resolve calibration for all sbids at once
+        try:
+            calinfos = BatchCalFinder(
+                sbid_to_run, conn=self.conn, cur=self.cur
+            ).query(timethreshold=timethreshold)
+        except Exception as error:
+            log.warning(f"failed to resolve calibration in batch - {error}... query one by one...")
+            self.conn.rollback()
+            calinfos = {}
+
+        newcalsbids = set() # calibration scheduled in this round
+        for sbid in sbid_to_run:
+            calinfo = calinfos.get(sbid)
+            if calinfo is not None and calinfo[0] is None and calinfo[2] in newcalsbids:
+                log.info(f"calibration {calinfo[2]} for {sbid} has just been scheduled... wait for it to finish...")
+                continue
+            newcalsbid = self._sbid_run(sbid=sbid, timethreshold=timethreshold, calinfo=calinfo)
+            if newcalsbid is not None: newcalsbids.add(newcalsbid)
+            time.sleep(1.5) # sleep for 1 second so that slack to display everything
+
+    def run(self, timethreshold=1., listen=True, fullsweep=3600):
+        """
+        run the scheduler
+
+        if `listen` is True, the scheduler reacts to database notification and new metadata files,
+        and only re-evaluates sbids that changed. A full sweep is still performed every `fullsweep` seconds.
+        otherwise, query all sbids every `self.sleeptime` seconds
+        """
         self.slackbot.post_message(
             "*[SCHEDULER]* automatic scheduler has been enabled"
         )
+
+        listener = None
+        if listen:
+            try: listener = SchedEventListener()
+            except Exception as error:
+                log.warning(f"cannot listen to database notification - {error}... fall back to polling...")
+
+        lastsweep = 0
         try:
             while True: #
                 try:
-                    sbid_to_run = self._query_nonrun_sbid()
-                    log.info(f"found {len(sbid_to_run)} schedule blocks to be processed...")
-                    for sbid in sbid_to_run:
-                        self._sbid_run(sbid=sbid, timethreshold=timethreshold)
-                        time.sleep(1.5) # sleep for 1 second so that slack to display everything
-                    time.sleep(self.sleeptime)
+                    if listener is None:
+                        self._run_sbids(self._query_nonrun_sbid(), timethreshold=timethreshold)
+                        time.sleep(self.sleeptime)
+                        continue
+
+                    if time.time() - lastsweep >= fullsweep:
+                        lastsweep = time.time()
+                        self._run_sbids(self._query_nonrun_sbid(), timethreshold=timethreshold)
+                    
+                    events = listener.wait(timeout=1.)
+                    if sum([len(v) for v in events.values()]) == 0: continue
+                    log.info(f"received events - {events}")
+                    self._run_sbids(
+                        self._query_event_sbid(events, timethreshold=timethreshold), 
+                        timethreshold=timethreshold
+                    )
                 except Exception as error:
                     self.slackbot.post_message(
                         f"*[SCHEDULER]* exception raised - {error}"
@@ -1123,13 +2168,11 @@ def update_table_single_entry(sbid, column, value, table, conn=None, cur=None,):
     if cur is None:
         cur = conn.cursor()
 
-    if isinstance(value, str):
-        value = f"""'{value}'"""
     ### update part not if there is nothing if we update nothing
-    updatesql = f"""UPDATE {table}
-SET {column}={value} WHERE sbid={sbid}
-"""
-    cur.execute(updatesql)
+    updatesql = psql.SQL("UPDATE {table} SET {column}=%s WHERE sbid=%s").format(
+        table=psql.Identifier(table), column=psql.Identifier(column),
+    )
+    cur.execute(updatesql, (_to_sql_value(value), int(sbid)))
     conn.commit()    
 
 def query_table_single_column(sbid, column, table, conn=None, cur=None):
@@ -1138,8 +2181,10 @@ def query_table_single_column(sbid, column, table, conn=None, cur=None):
     if cur is None:
         cur = conn.cursor()
 
-    sql = f"""SELECT {column} FROM {table} WHERE sbid={sbid}"""
-    cur.execute(sql)
+    sql = psql.SQL("SELECT {column} FROM {table} WHERE sbid=%s").format(
+        table=psql.Identifier(table), column=psql.Identifier(column),
+    )
+    cur.execute(sql, (int(sbid), ))
     res = cur.fetchone()
 
     if res is None: return None
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+### consolidated calibration solution for a given sbid - one file for all beams that can be memory mapped
+
+"""
+file layout
+    b"CRACOCAL" - magic
+    uint64 (little endian) - length of the header
+    header - json, with the shape, dtype and offset of each array
+    arrays - each of them starts at a 64 bytes boundary
+
+arrays
+    bin - binary bandpass, (nbeam, nant, nchan, npol), complex
+    smooth - smooth bandpass, (nbeam, nant, nchan, npol), complex
+    freqs - frequencies, (nbeam, nchan)
+    valid - whether the solution for the beam is loaded, (nbeam, )
+"""
+
+import numpy as np
+import logging
+import json
+import os
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+CALSOL_STORE_NAME = "calsol.cracocal"
+CALSOL_STORE_MAGIC = b"CRACOCAL"
+CALSOL_STORE_VERSION = 1
+_ALIGN = 64
+
+def calsol_store_path(caldir):
+    return f"{caldir}/{CALSOL_STORE_NAME}"
+
+def _align(offset):
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+def _load_beam_solution(caldir, ibeam):
+    """load binary bandpass, smooth bandpass and frequencies for a given beam"""
+    from craco import plotbp
+    binbp = plotbp.Bandpass.load(caldir.beam_cal_binfile(ibeam)).bandpass[0]
+    smobp = np.load(caldir.beam_cal_smoothfile(ibeam))[0]
+    freqs = np.load(caldir.beam_cal_freqfile(ibeam))
+    return binbp, smobp, freqs
+
+def write_calsol_store(sbid, fname=None, nbeam=36):
+    """
+    consolidate calibration solutions of all beams under the head node calibration directory
+
+    return the number of beams written
+    """
+    from craco.datadirs import CalDir
+    caldir = CalDir(sbid)
+    if fname is None: fname = calsol_store_path(caldir.cal_head_dir)
+
+    solutions = {}
+    for ibeam in range(nbeam):
+        try: solutions[ibeam] = _load_beam_solution(caldir, ibeam)
+        except Exception as error:
+            log.info(f"cannot load solution from beam {ibeam} for {sbid}... error - {error}")
+
+    if len(solutions) == 0:
+        log.warning(f"no calibration solution found for {sbid}... no store written")
+        return 0
+
+    ### use the shape of the first beam, beams with other shapes are treated as invalid
+    binbp0, smobp0, freqs0 = solutions[min(solutions)]
+    arrays = {
+        "bin": np.zeros((nbeam, ) + binbp0.shape, dtype=binbp0.dtype),
+        "smooth": np.zeros((nbeam, ) + smobp0.shape, dtype=smobp0.dtype),
+        "freqs": np.zeros((nbeam, ) + freqs0.shape, dtype=freqs0.dtype),
+        "valid": np.zeros(nbeam, dtype=bool),
+    }
+    for ibeam, (binbp, smobp, freqs) in solutions.items():
+        if binbp.shape != binbp0.shape or smobp.shape != smobp0.shape or freqs.shape != freqs0.shape:
+            log.warning(f"unexpected solution shape for beam {ibeam}... treat it as invalid")
+            continue
+        arrays["bin"][ibeam] = binbp
+        arrays["smooth"][ibeam] = smobp
+        arrays["freqs"][ibeam] = freqs
+        arrays["valid"][ibeam] = True
+
+    ### work out the header, header length can change with offsets, so iterate until it is stable
+    header = dict(version=CALSOL_STORE_VERSION, sbid=str(sbid), nbeam=nbeam, arrays={})
+    datastart = 0
+    while True:
+        offset = datastart
+        for name, arr in arrays.items():
+            header["arrays"][name] = dict(dtype=arr.dtype.str, shape=list(arr.shape), offset=offset)
+            offset = _align(offset + arr.nbytes)
+        headerbytes = json.dumps(header).encode("utf-8")
+        newstart = _align(len(CALSOL_STORE_MAGIC) + 8 + len(headerbytes))
+        if newstart == datastart: break
+        datastart = newstart
+
+    tmpname = f"{fname}.{os.getpid()}.tmp"
+    with open(tmpname, "wb") as fp:
+        fp.write(CALSOL_STORE_MAGIC)
+        fp.write(np.uint64(len(headerbytes)).tobytes())
+        fp.write(headerbytes)
+        for name, arr in arrays.items():
+            fp.seek(header["arrays"][name]["offset"])
+            fp.write(np.ascontiguousarray(arr).tobytes())
+    os.replace(tmpname, fname)
+
+    nvalid = int(arrays["valid"].sum())
+    log.info(f"{nvalid} beams written to calibration store {fname}")
+    return nvalid
+
+def remove_calsol_store(caldir):
+    """remove existing store, e.g., before copying a new solution"""
+    fname = calsol_store_path(caldir)
+    if os.path.exists(fname):
+        log.info(f"removing existing calibration store {fname}")
+        os.remove(fname)
+
+class CalSolStore:
+    """
+    read-only, memory mapped calibration solution store
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, "rb") as fp:
+            magic = fp.read(len(CALSOL_STORE_MAGIC))
+            if magic != CALSOL_STORE_MAGIC:
+                raise ValueError(f"{fname} is not a calibration store...")
+            headerlen = int(np.frombuffer(fp.read(8), dtype=np.uint64)[0])
+            self.header = json.loads(fp.read(headerlen).decode("utf-8"))
+        if self.header["version"] != CALSOL_STORE_VERSION:
+            raise ValueError(f"unsupported calibration store version {self.header['version']}")
+
+        self._mmap = np.memmap(fname, dtype=np.uint8, mode="r")
+        self.arrays = {
+            name: np.ndarray(
+                tuple(info["shape"]), dtype=np.dtype(info["dtype"]),
+                buffer=self._mmap, offset=info["offset"],
+            )
+            for name, info in self.header["arrays"].items()
+        }
+
+    @property
+    def nbeam(self):
+        return self.header["nbeam"]
+
+    @property
+    def binbp(self):
+        return self.arrays["bin"]
+
+    @property
+    def smobp(self):
+        return self.arrays["smooth"]
+
+    @property
+    def freqs(self):
+        return self.arrays["freqs"]
+
+    @property
+    def valid(self):
+        return self.arrays["valid"]
+
+    @property
+    def beams(self):
+        return np.where(self.valid)[0]
+
+    @property
+    def solnum(self):
+        return int(self.valid.sum())
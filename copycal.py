@@ -1,16 +1,34 @@
 #!/usr/bin/env python
 
 import os
+import re
+import sys
+import time
 import glob
+import json
+import fcntl
+import signal
+import hashlib
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 from craco.craco_run.auto_sched import (
-    query_table_single_column
+    query_table_single_column, upsert_calibration,
+    push_sbid_calibration, CracoCalSol,
+)
+from craco.craco_run.calstore import (
+    write_calsol_store, remove_calsol_store
 )
 
 import logging
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+CALSOL_MANIFEST_NAME = "calsol.manifest.json"
+CALSOL_LOCK_NAME = "copycal.lock" # held while copying or writing the solution
+CALSOL_STREAM_PID_NAME = "copycal.stream.pid" # pid of the running streamer
+CALSOL_SMOOTH_PATTERN = re.compile(r"\d\d/b\d\d\.aver\.4pol\.smooth\.npy")
+
 def _format_sbid(sbid, padding=True):
     "perform formatting for the sbid"
     if isinstance(sbid, int): sbid = str(sbid)
@@ -19,17 +37,56 @@ def _format_sbid(sbid, padding=True):
         return f"SB{sbid}"
     return sbid
 
+def _file_sha1(fname, chunksize=2**22):
+    sha1 = hashlib.sha1()
+    with open(fname, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunksize), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def copy_verified(src, dst, chunksize=2**22):
+    """
+    copy src to dst through a temporary file, which is only moved into place 
+    if both size and checksum match the source
+
+    return size and sha1 of the file
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmpname = f"{dst}.{os.getpid()}.tmp"
+    sha1 = hashlib.sha1(); size = 0
+    try:
+        with open(src, "rb") as fin, open(tmpname, "wb") as fout:
+            for chunk in iter(lambda: fin.read(chunksize), b""):
+                sha1.update(chunk); fout.write(chunk)
+                size += len(chunk)
+        if size != os.path.getsize(src) or os.path.getsize(tmpname) != size:
+            raise IOError(f"size mismatch when copying {src}...")
+        if _file_sha1(tmpname) != sha1.hexdigest():
+            raise IOError(f"checksum mismatch when copying {src}...")
+        os.replace(tmpname, dst)
+    finally:
+        if os.path.exists(tmpname): os.remove(tmpname)
+    return size, sha1.hexdigest()
+
+def _beam_of(relpath):
+    """beam directory (two digits) of a file relative to the calibration directory, None for other files"""
+    beam = relpath.split("/")[0]
+    if re.fullmatch(r"\d\d", beam) and "/" in relpath: return beam
+    return None
+
 class CalSolCopier:
-    def __init__(self, calsbid):
+    def __init__(self, calsbid, nworkers=8, nodes=range(1, 19)):
+        self.sbid = calsbid
         self.calsbid = _format_sbid(calsbid)
+        self.nworkers = nworkers
+        self.nodes = list(nodes)
         self.check_cal_status(calsbid)
         self.make_cal_dir()
 
     def make_cal_dir(self):
         if os.path.exists(self.caldir): # if the calibration folder exists...
             if not self.DONOTUPDATE: # and you wish to update it...
-                log.info("existing calibration directory found... delete it...")
-                os.system(f"rm -r {self.caldir}")
+                log.info("existing calibration directory found... only changed files will be copied...")
         else: # if the calibration solution does not exist...
             self.DONOTUPDATE = False # you want to update it anyway....
 
@@ -48,26 +105,300 @@ class CalSolCopier:
     def caldir(self):
         return f"/CRACO/DATA_00/craco/calibration/{self.calsbid}"
 
+    @property
+    def manifest_path(self):
+        return f"{self.caldir}/{CALSOL_MANIFEST_NAME}"
+
+    @property
+    def lock_path(self):
+        return f"{self.caldir}/{CALSOL_LOCK_NAME}"
+
+    @property
+    def stream_pid_path(self):
+        return f"{self.caldir}/{CALSOL_STREAM_PID_NAME}"
+
+    @contextmanager
+    def lock(self):
+        """
+        exclusive lock on the calibration directory, so that the streamer and the final copy 
+        do not write manifest, store and calibration table at the same time
+        """
+        os.makedirs(self.caldir, exist_ok=True)
+        with open(self.lock_path, "a") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try: yield
+            finally: fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def _stream_pid(self):
+        """pid of the streamer, None if there is no streamer running (e.g., stale pid file)"""
+        try:
+            with open(self.stream_pid_path) as fp: pid = int(fp.read().strip())
+            with open(f"/proc/{pid}/cmdline", "rb") as fp: cmdline = fp.read()
+        except Exception: return None
+        if b"copycal" not in cmdline: return None # pid has been reused by something else
+        return pid
+
+    def stop_stream(self, wait=60):
+        """stop the streamer for this calibration if it is still running"""
+        pid = self._stream_pid()
+        if pid is None or pid == os.getpid(): return
+        try: os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError: return
+        log.info(f"stopping calibration streamer {pid} for {self.calsbid}...")
+        tstart = time.time()
+        while time.time() - tstart < wait:
+            if self._stream_pid() != pid: return # pid file removed or process gone
+            time.sleep(1)
+        log.warning(f"streamer {pid} does not stop in {wait} seconds... kill it...")
+        try: os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError: pass
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path) as fp:
+                return json.load(fp)
+        except Exception:
+            return dict(files={})
+
+    def _dump_manifest(self, manifest):
+        tmpname = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmpname, "w") as fp:
+            json.dump(manifest, fp, indent=1)
+        os.replace(tmpname, self.manifest_path)
+
+    def _list_sources(self):
+        """
+        all files in calibration directories on each node, 
+        same files on a later node take precedence (as the order of `cp`)
+
+        return a dictionary of relative path -> (node, source path, stat)
+        """
+        sources = {}
+        for node in self.nodes:
+            caldir_node = f"/CRACO/DATA_{node:0>2}/craco/calibration/{self.calsbid}"
+            for root, dirs, files in os.walk(caldir_node):
+                for fname in files:
+                    src = os.path.join(root, fname)
+                    relpath = os.path.relpath(src, caldir_node)
+                    try: sources[relpath] = (node, src, os.stat(src))
+                    except FileNotFoundError: continue
+        return sources
+
+    def _gather_file(self, relpath, node, src, stat, previous):
+        """copy a single file, return manifest entry for it and whether it is skipped"""
+        dst = f"{self.caldir}/{relpath}"
+        entry = dict(node=node, size=stat.st_size, mtime=stat.st_mtime_ns)
+        if (
+            previous is not None and previous.get("sha1") is not None
+            and all(previous.get(key) == value for key, value in entry.items())
+            and os.path.exists(dst) and os.path.getsize(dst) == stat.st_size
+        ):
+            return previous, True
+        size, sha1 = copy_verified(src, dst)
+        entry.update(size=size, sha1=sha1)
+        return entry, False
+
+    def _prune_stale(self, sources):
+        """remove files in beam directories on the head node that are no longer in any node"""
+        for dst in glob.glob(f"{self.caldir}/??/**", recursive=True):
+            relpath = os.path.relpath(dst, self.caldir)
+            if os.path.isfile(dst) and _beam_of(relpath) is not None and relpath not in sources:
+                log.info(f"removing stale calibration file {dst}")
+                os.remove(dst)
+
+    def _copy_sources(self, sources, previous):
+        """copy a set of files concurrently, return manifest entries for copied files and errors for failed ones"""
+        files = {}; failed = {}; nskip = 0
+        with ThreadPoolExecutor(max_workers=self.nworkers) as executor:
+            futures = {
+                relpath: executor.submit(self._gather_file, relpath, node, src, stat, previous.get(relpath))
+                for relpath, (node, src, stat) in sources.items()
+            }
+            for relpath, future in futures.items():
+                try: 
+                    files[relpath], skipped = future.result()
+                    nskip += skipped
+                except Exception as error:
+                    log.warning(f"failed to copy {relpath} from node{sources[relpath][0]}... error - {error}")
+                    failed[relpath] = str(error)
+        log.info(f"{len(files) - nskip} files copied, {nskip} unchanged files skipped, {len(failed)} files failed...")
+        return files, failed
+
+    def _complete_beams(self, files, failed):
+        """
+        a beam is complete only if all of its files are copied
+        smooth solution is what marks a beam as solved, remove it for a half copied beam
+        """
+        badbeams = {_beam_of(relpath) for relpath in failed}
+        for beam in badbeams:
+            if beam is None: continue
+            for fname in glob.glob(f"{self.caldir}/{beam}/b??.aver.4pol.smooth.npy"):
+                os.remove(fname)
+        return sorted({_beam_of(relpath) for relpath in files} - badbeams - {None})
+
+    def gather(self):
+        """
+        copy all files from nodes concurrently with size and checksum verification,
+        unchanged files since the last copy (based on the manifest) are skipped
+
+        return the manifest
+        """
+        previous = self._load_manifest().get("files", {})
+        sources = self._list_sources()
+        log.info(f"{len(sources)} calibration files found on {len(self.nodes)} nodes...")
+
+        files, failed = self._copy_sources(sources, previous)
+        self._prune_stale(sources)
+        beams = self._complete_beams(files, failed)
+
+        manifest = dict(
+            sbid=str(self.sbid), nbeam=len(beams), beams=beams,
+            complete=(len(beams) == 36 and len(failed) == 0),
+            files=files, failed=failed,
+        )
+        self._dump_manifest(manifest)
+        return manifest
+
     def run(self):
         """
         copy all available calibration to head node...
+
+        return True if all 36 beams are copied successfully
         """
         if self.DONOTUPDATE:
             log.info("there is already a good calibration existing... will not update it")
-            return 
-        for node in range(1, 19):
-            caldir_node = f"/CRACO/DATA_{node:0>2}/craco/calibration/{self.calsbid}"
-            cpcmd = f"cp -r {caldir_node}/* {self.caldir}"
-            log.info(f"copying calibration solution from node{node}...")
-            os.system(cpcmd)
+            return True
+        remove_calsol_store(self.caldir) # it will be written again after copying
+        manifest = self.gather()
 
         ### check the number of solution
-        nsol = len(glob.glob(f"{self.caldir}/??"))
-        if nsol != 36:
-            log.warning(f"solution not completed... {nsol} beams found...")
+        if not manifest["complete"]:
+            log.warning(f"solution not completed... {manifest['nbeam']} beams found, {len(manifest['failed'])} files failed...")
         else:
             log.info("all calibration solution copied successfully...")
 
+        ### consolidate all beams into one file, half copied solution will not be consolidated
+        if len(manifest["failed"]) == 0:
+            try: write_calsol_store(self.sbid)
+            except Exception as error:
+                log.warning(f"failed to write calibration store... error - {error}")
+        return manifest["complete"]
+
+    def _beam_qc(self, calsol, good_ant, beam, phase_difference_threshold=30, bad_frac_threshold=0.4):
+        """quality check for a single beam, same statistics as `CracoCalSol.rank_calsol`"""
+        phdif = calsol._load_beam_phase_diff(int(beam), good_ant)
+        good_frac = (phdif < phase_difference_threshold).mean(axis=-1).mean()
+        return good_frac > bad_frac_threshold, good_frac
+
+    def stream(self, interval=60, timeout=86400, nbeam=36):
+        """
+        copy solution beam by beam as soon as `b??.aver.4pol.smooth.npy` for the beam appears (and stops changing) on its node,
+        each beam is checked on its own, and the progress is pushed to the calibration table (status 1 - running)
+        once all beams are in, the solution is consolidated and ranked (status 0)
+
+        it should be started together with the calibration, only solutions written after that are accepted,
+        and it is stopped by the final copy (see `stop_stream`) if it is still running by then
+
+        return True if all beams are copied successfully
+        """
+        if self.DONOTUPDATE:
+            log.info("there is already a good calibration existing... will not update it")
+            return True
+
+        self.stop_stream() # only one streamer for a given calibration
+        with open(self.stream_pid_path, "w") as fp: fp.write(str(os.getpid()))
+        ### make sure temporary files and the pid file are cleaned up when being stopped
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+        try:
+            return self._stream(interval=interval, timeout=timeout, nbeam=nbeam)
+        finally:
+            if self._stream_pid() == os.getpid(): os.remove(self.stream_pid_path)
+
+    def _stream(self, interval=60, timeout=86400, nbeam=36):
+        tstart = time.time()
+        since = int(tstart * 1e9) # solutions from previous calibrations are older than that
+        with self.lock(): remove_calsol_store(self.caldir) # it will be written again after copying
+
+        previous = self._load_manifest().get("files", {})
+        files = {}; failed = {}; beamqc = {}
+        lastseen = {} # smooth solution stat when we last saw it, only copy a beam when it is stable
+        calsol = None; good_ant = None
+
+        while len(beamqc) < nbeam:
+            if time.time() - tstart > timeout:
+                log.warning(f"timeout when waiting for calibration solution... {len(beamqc)} beams copied...")
+                break
+
+            sources = self._list_sources()
+            readybeams = []
+            for relpath, (node, src, stat) in sources.items():
+                if not CALSOL_SMOOTH_PATTERN.fullmatch(relpath): continue
+                beam = _beam_of(relpath)
+                if beam in beamqc or stat.st_mtime_ns < since: continue
+                key = (node, stat.st_size, stat.st_mtime_ns)
+                if lastseen.get(beam) == key: readybeams.append(beam)
+                lastseen[beam] = key
+
+            if len(readybeams) > 0:
+                log.info(f"copying beams {readybeams} for {self.calsbid}...")
+                beamsources = {
+                    relpath: source for relpath, source in sources.items() 
+                    if _beam_of(relpath) in readybeams
+                }
+                with self.lock():
+                    newfiles, newfailed = self._copy_sources(beamsources, previous)
+                files.update(newfiles); failed.update(newfailed)
+
+                if calsol is None:
+                    try: 
+                        calsol = CracoCalSol(self.sbid)
+                        good_ant = calsol.good_ant
+                    except Exception as error:
+                        log.warning(f"cannot check calibration solution beam by beam... error - {error}")
+                
+                for beam in self._complete_beams(newfiles, newfailed):
+                    try: beamqc[beam] = self._beam_qc(calsol, good_ant, beam)
+                    except Exception as error:
+                        log.warning(f"failed to check solution for beam {beam}... error - {error}")
+                        beamqc[beam] = (False, None)
+                    log.info(f"beam {beam} copied - good {beamqc[beam][0]} with good fraction {beamqc[beam][1]}")
+                for relpath in newfailed: lastseen.pop(_beam_of(relpath), None) # try again
+
+                ### progressive update
+                with self.lock():
+                    self._dump_manifest(dict(
+                        sbid=str(self.sbid), nbeam=len(beamqc), beams=sorted(beamqc), complete=False,
+                        files=files, failed=failed,
+                    ))
+                    try:
+                        upsert_calibration([dict(
+                            sbid=int(self.sbid), valid=False, solnum=len(beamqc), goodant=-1,
+                            goodbeam=int(sum(good for good, _ in beamqc.values())), status=1,
+                        )])
+                    except Exception as error:
+                        log.warning(f"failed to push calibration progress to database... error - {error}")
+
+            if len(beamqc) < nbeam: time.sleep(interval)
+
+        complete = len(beamqc) == nbeam and len(failed) == 0
+        with self.lock():
+            self.check_cal_status(self.sbid) # the final copy may have finished it in the meantime
+            if self.DONOTUPDATE:
+                log.info("calibration has been finalised by another copy... will not update it")
+                return True
+            self._dump_manifest(dict(
+                sbid=str(self.sbid), nbeam=len(beamqc), beams=sorted(beamqc), complete=complete,
+                files=files, failed=failed,
+            ))
+            if not complete: return False
+
+            log.info("all calibration solution copied successfully... ranking the solution...")
+            try: write_calsol_store(self.sbid)
+            except Exception as error:
+                log.warning(f"failed to write calibration store... error - {error}")
+            push_sbid_calibration(sbid=self.sbid, prepare=False, plot=True, updateobs=True)
+        return True
+
 def main():
     from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
     parser = ArgumentParser(
@@ -76,10 +407,22 @@ def main():
     )
 
     parser.add_argument("-cal", "--calsbid", type=str, help="calibration schedule block", )
+    parser.add_argument("-n", "--nworkers", type=int, help="number of files to be copied concurrently", default=8)
+    parser.add_argument("--stream", help="copy solution beam by beam while calibration is running", default=False, action="store_true")
+    parser.add_argument("--interval", type=float, help="interval in seconds to check new solutions in stream mode", default=60)
+    parser.add_argument("--timeout", type=float, help="maximum time in seconds to wait for all solutions in stream mode", default=86400)
     values = parser.parse_args()
 
-    copier = CalSolCopier(values.calsbid)
-    copier.run()
+    copier = CalSolCopier(values.calsbid, nworkers=values.nworkers)
+    if values.stream: 
+        success = copier.stream(interval=values.interval, timeout=values.timeout)
+    else:
+        ### the calibration has finished by now, the final copy takes over from the streamer
+        copier.stop_stream()
+        with copier.lock(): 
+            copier.check_cal_status(copier.sbid) # status may be changed by the streamer before we got the lock
+            success = copier.run()
+    if not success: sys.exit(1)
 
 if __name__ == "__main__":
     main()
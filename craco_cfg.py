@@ -27,6 +27,16 @@ CAL_TS_ONFINISH     =       "/CRACO/SOFTWARE/craco/craftop/softwares/craco_run/t
 PIPE_RUN_TS_SOCKET  =       "/data/craco/craco/tmpdir/queues"
 CAL_RUN_TS_SOCKET   =       "/data/craco/craco/tmpdir/queues/cal"
 
+# metadata related
+STREAM_METADATA     =       True                # parse metadata files incrementally (needs ijson), less memory for long SBs
+
+# cache related
+SB_CACHE_DIR        =       "/CRACO/DATA_00/craco/sbcache"       # cached schedblock information from aces
+
+# astropy related
+ASTROPY_OFFLINE     =       True                # never download sites registry or IERS tables
+IERS_A_FILE         =       "/CRACO/DATA_00/craco/iers/finals2000A.all" # updated by auto_sched.fetch_iers_snapshot
+
 ####### the following for testing locally only
 # PIPE_TS_ONFINISH    =       "/Users/zwang/Documents/Curtin/craco_run/ts_piperun_call.py"
 # CAL_TS_ONFINISH     =       "/Users/zwang/Documents/Curtin/craco_run/ts_calibration_call.py"
@@ -1,7 +1,9 @@
 import os
 import glob
+import json
 import argparse
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from craft.cmdline import strrange
 import shutil
 
@@ -32,11 +34,86 @@ def parse_sbid(sbid):
         raise ValueError(f"Malformed SBID - {sbid}")
         
 
-def delete_path(path):
+def delete_path(path, dry=False):
     log.debug(f"Deleting {path}")
-    if not args.dry:
+    if not dry:
         os.remove(path)
 
+def _uvfits_beam(fname):
+    """beam number for b??.uvfits, None for other files"""
+    if fname.startswith("b") and fname.endswith(".uvfits"):
+        beam = fname[1:-len(".uvfits")]
+        if beam.isdigit(): return int(beam)
+    return None
+
+def _fil_beam(fname):
+    """beam number for ics*.fil or cas*.fil (e.g., cas_b00.fil), None for other files"""
+    if (fname.startswith("ics") or fname.startswith("cas")) and fname.endswith(".fil"):
+        beam = fname[:-len(".fil")].split("_")[-1].lstrip("b")
+        if beam.isdigit(): return int(beam)
+    return None
+
+def _select_beam(beam, keep_beams=None, delete_beams=None):
+    if keep_beams is not None: return beam not in keep_beams
+    if delete_beams is not None: return beam in delete_beams
+    return True
+
+def _walk_scans(root_path):
+    """
+    walk through scans/??/202*/ under root_path in one go
+    yield os.DirEntry for all files in scan directories
+    """
+    scansdir = os.path.join(root_path, "scans")
+    if not os.path.isdir(scansdir): return
+    with os.scandir(scansdir) as scannums:
+        for scannum in scannums:
+            if len(scannum.name) != 2 or not scannum.is_dir(): continue
+            with os.scandir(scannum.path) as scantimes:
+                for scantime in scantimes:
+                    if not scantime.name.startswith("202") or not scantime.is_dir(): continue
+                    with os.scandir(scantime.path) as entries:
+                        for entry in entries:
+                            if entry.is_file(follow_symlinks=False): yield entry
+
+def delete_node(root_path, dry=False, keep_beams=None, delete_beams=None, only_fils=False, only_uvfits=False):
+    """
+    delete uvfits and fil files for a given node (root_path is /CRACO/DATA_??/craco/SB0xxxxx)
+
+    return a report with the number of files found/deleted/skipped, bytes freed and errors
+    """
+    node_name = root_path.strip().split("/")[2]
+    report = dict(
+        node=node_name, nuvfits=0, nfil=0, ndeleted=0, 
+        nskipped=0, bytes=0, errors=[],
+    )
+    try:
+        for entry in _walk_scans(root_path):
+            uvfitsbeam = _uvfits_beam(entry.name)
+            filbeam = _fil_beam(entry.name)
+            if uvfitsbeam is not None:
+                report["nuvfits"] += 1
+                if only_fils: continue
+                beam = uvfitsbeam
+            elif filbeam is not None:
+                report["nfil"] += 1
+                if only_uvfits: continue
+                beam = filbeam
+            else: continue
+
+            if not _select_beam(beam, keep_beams, delete_beams):
+                log.debug(f"I am skipping Beam {beam:02g} - {entry.path}")
+                report["nskipped"] += 1
+                continue
+
+            try:
+                size = entry.stat(follow_symlinks=False).st_size
+                delete_path(entry.path, dry=dry)
+                report["ndeleted"] += 1; report["bytes"] += size
+            except Exception as error:
+                report["errors"].append(f"{entry.path} - {error}")
+    except Exception as error:
+        report["errors"].append(f"{root_path} - {error}")
+    return report
 
 def main(args):
     log.info("---------------------------------------------------------------")
@@ -49,80 +126,46 @@ def main(args):
     if os.path.exists(keepfile):
         log.info(f'{sbid} contains KEEP file. ignoring')
         return
-    
-    update_table_single_entry(int(args.sbid), "delete", True, "observation")
 
-    root_paths = glob.glob(root_regex)
+    root_paths = [path for path in glob.glob(root_regex) if path.strip().split("/")[2] != "DATA_00"]
     if len(root_paths) == 0:
-        log.info(f"No directories exist on any of the SKADI nodes for the requested SBID - {sbid}")
+        log.info(f"No data directories exist on any of the SKADI nodes (except SKADI_0) for the requested SBID - {sbid}")
+        reports = []
     else:
-        for root_path in root_paths:
-            node_name = root_path.strip().split("/")[2]
-            if node_name == "DATA_00":
-                if len(root_paths) == 1:
-                    log.info(f"No data directories exist on any of the SKADI nodes (except SKADI_0) for the requested SBID - {sbid}")
-                continue
-            
-            uvfits_regex = os.path.join(root_path, "scans/??/202*/b??.uvfits")
-            uvfits_paths = glob.glob(uvfits_regex)
-            
-            ics_regex = os.path.join(root_path, "scans/??/202*/ics*.fil")
-            ics_paths = glob.glob(ics_regex)
-            cas_regex = os.path.join(root_path, "scans/??/202*/cas*.fil")
-            cas_paths = glob.glob(cas_regex)
-
-            filts_paths = cas_paths + ics_paths
-
-            all_paths = uvfits_paths + filts_paths
-
-            log.info(f"Found {len(uvfits_paths)} uvfits files and {len(filts_paths)} fil files on node {node_name}")
-            
-            if not args.only_fils:
-                if len(uvfits_paths) == 0:
-                    log.info(f"No uvfits files found on {node_name}! The regex I used was: {uvfits_regex}")
-
-                else:
-                    for uvfits_path in uvfits_paths:
-                        beam_no = int(uvfits_path.split("/")[-1].strip(".uvfits").strip("b"))
-                        if args.keep_beams is not None:
-                            if beam_no in args.keep_beams:
-                                log.info(f"I am skipping Beam {beam_no:02g} because I was asked to keep these beams - {args.keep_beams}")
-                                pass
-                            else:
-                                delete_path(uvfits_path)
-
-                        elif args.delete_beams is not None:
-                            if beam_no in args.delete_beams:
-                                delete_path(uvfits_path)
-                            else:
-                                log.info(f"I am skipping Beam {beam_no:02g} because I was asked to delete only these beams - {args.delete_beams}")
-                                pass
-                        else:
-                            delete_path(uvfits_path)
-            
-            if not args.only_uvfits:
-                if len(filts_paths) == 0:
-                    log.info(f"No fil files found on {node_name}! The regex I used was: {ics_regex} and {cas_regex}")
-
-                else:
-                    for fil_path in filts_paths:
-                        beam_no = int((fil_path.split("/")[-1]).split("_")[-1].strip(".fil").strip("b"))
-                        if args.keep_beams is not None:
-                            if beam_no in args.keep_beams:
-                                log.info(f"I am skipping Beam {beam_no:02g} because I was asked to keep these beams - {args.keep_beams}")
-                                pass
-                            else:
-                                delete_path(fil_path)
-
-                        elif args.delete_beams is not None:
-                            if beam_no in args.delete_beams:
-                                delete_path(fil_path)
-                            else:
-                                log.info(f"I am skipping Beam {beam_no:02g} because I was asked to delete only these beams - {args.delete_beams}")
-                                pass
-                        else:
-                            delete_path(fil_path)
-
+        ### each node is handled on its own, all nodes at the same time
+        with ThreadPoolExecutor(max_workers=len(root_paths)) as executor:
+            reports = list(executor.map(
+                lambda root_path: delete_node(
+                    root_path, dry=args.dry, keep_beams=args.keep_beams, delete_beams=args.delete_beams,
+                    only_fils=args.only_fils, only_uvfits=args.only_uvfits,
+                ), sorted(root_paths)
+            ))
+
+    for report in reports:
+        log.info(
+            f"Found {report['nuvfits']} uvfits files and {report['nfil']} fil files on node {report['node']} - "
+            f"{report['ndeleted']} deleted, {report['nskipped']} skipped, {report['bytes'] / 1024 ** 3:.2f} GB freed"
+        )
+        for error in report["errors"]:
+            log.error(f"failed to delete on node {report['node']} - {error}")
+
+    nerror = sum(len(report["errors"]) for report in reports)
+    summary = dict(
+        sbid=sbid, dry=args.dry, nerror=nerror,
+        ndeleted=sum(report["ndeleted"] for report in reports),
+        bytes=sum(report["bytes"] for report in reports),
+        nodes=reports,
+    )
+    log.info(f"deletion summary - {json.dumps(summary)}")
+
+    ### only flag the sbid as deleted if everything went well
+    if args.dry:
+        log.info("dry run... database is not updated")
+    elif nerror > 0:
+        log.error(f"{nerror} errors found when deleting {sbid}... database is not updated")
+    else:
+        update_table_single_entry(int(args.sbid), "delete", True, "observation")
+    return summary
 
 
 if __name__ == '__main__':
@@ -1,19 +1,29 @@
 #!/usr/bin/env python
 ### functions to get 1) bad antennas; 2) get starting and end time
 
-from scipy.interpolate import interp1d
-
+from functools import lru_cache
 import numpy as np
+import hashlib
 import logging
+import gzip
 import json
 import re
 import os
 
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+    log.debug("cannot load ijson package... streaming metadata is not available")
+
 from craco.metadatafile import MetadataFile 
 from craco.datadirs import SchedDir, ScanDir
+from uvfitsinfo import read_uvfits_header, read_uvfits_headers, uvfits_mjd_start
 
-log = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO)
+ANTFLAG_SUMMARY_VERSION = 2
 
 def _format_sbid(sbid, padding=True):
     "perform formatting for the sbid"
@@ -23,23 +33,11 @@ def _format_sbid(sbid, padding=True):
         return f"SB{sbid}"
     return sbid
 
-def get_mjd_start_from_uvfits_header(fname, hdr_size = 16384):
+def get_mjd_start_from_uvfits_header(fname):
     """
     load PZERO4 from fits header directly
     """
-    with open(fname, 'rb') as o:
-        raw_h = o.read(hdr_size)
-    pattern = "PZERO4\s*=\s*(\d+.\d+)\s*"
-    matches = re.findall(pattern, str(raw_h))
-    if len(matches) !=1:
-        raise RuntimeError(f"Something went wrong when looking for mjd start in the header, I used this regex - {pattern}")
-
-    jd_start = float(matches[0])
-    mjd_start = jd_start - 2400000.5
-    if 50000 < mjd_start < 80000:
-        return mjd_start
-    else:
-        raise RuntimeError(f"I found a really unexpected value of MJD start from the UVfits header - {mjd_start}")
+    return uvfits_mjd_start(read_uvfits_header(fname))
 
 def find_true_range(bool_array):
     """
@@ -53,16 +51,271 @@ def find_true_range(bool_array):
 
     return ranges
 
+def metafile_stamp(metafile):
+    """size and modification time (in ns) of the metadata file, cheap to check before hashing it"""
+    stat = os.stat(metafile)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def hash_metafile(metafile, chunksize=2**22):
+    """
+    sha1 of the metadata file, used as the key of the antflag summary
+    the hash is cached until the size or modification time of the file changes
+    """
+    size, mtime_ns = metafile_stamp(metafile)
+    return _hash_metafile_cached(metafile, size, mtime_ns, chunksize)
+
+@lru_cache(maxsize=256)
+def _hash_metafile_cached(metafile, size, mtime_ns, chunksize):
+    sha1 = hashlib.sha1()
+    with open(metafile, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunksize), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def _runs_from_counts(times, nflag):
+    """
+    run-length encoding of the number of flagged antennas
+
+    return a dictionary of arrays - start/end (exclusive) sample index, 
+    tstart/tlast (time of the first/last sample) and nflag for each run
+    """
+    nflag = np.asarray(nflag)
+    change = np.flatnonzero(np.diff(nflag)) + 1
+    starts = np.concatenate([[0], change])
+    ends = np.concatenate([change, [len(nflag)]])
+    return dict(
+        start=starts, end=ends, tstart=times[starts], 
+        tlast=times[ends - 1], nflag=nflag[starts],
+    )
+
+def _meta_packet_mjd(packet):
+    """BAT timestamp (microseconds, TAI) to mjd, the same as `MetadataFile.times`"""
+    return packet["timestamp"] / 1e6 / 86400.
+
+def _meta_packet_flags(packet):
+    """antenna flags in a packet, ordered by antenna number, the same as `MetadataFile.antflags`"""
+    antennas = packet["antennas"]
+    antnames = sorted(antennas, key=lambda ant: int(re.sub(r"\D", "", ant) or 0))
+    return np.array([bool(antennas[ant]["flagged"]) for ant in antnames])
+
+def stream_meta_flags(metafile):
+    """
+    decompress and parse the metadata file packet by packet,
+    only keep flag counts for each antenna and runs of the number of flagged antennas (see `_runs_from_counts`)
+
+    return nt, flagantsum (na, ), runs
+    """
+    opener = gzip.open if metafile.endswith(".gz") else open
+    nt = 0; flagantsum = None
+    runs = dict(start=[], end=[], tstart=[], tlast=[], nflag=[])
+    with opener(metafile, "rb") as fp:
+        for packet in ijson.items(fp, "item", use_float=True):
+            mjd = _meta_packet_mjd(packet)
+            antflags = _meta_packet_flags(packet)
+            if flagantsum is None: flagantsum = np.zeros(len(antflags), dtype=int)
+            flagantsum += antflags
+            nflag = int(antflags.sum())
+
+            if nt == 0 or nflag != runs["nflag"][-1]:
+                if nt > 0: runs["end"].append(nt)
+                runs["start"].append(nt); runs["tstart"].append(mjd)
+                runs["tlast"].append(mjd); runs["nflag"].append(nflag)
+            else:
+                runs["tlast"][-1] = mjd
+            nt += 1
+    if nt == 0: raise ValueError(f"no data found in {metafile}")
+    runs["end"].append(nt)
+    return nt, flagantsum, {k: np.array(v) for k, v in runs.items()}
+
+class GoodIntervalIndex:
+    """
+    start mjd lookup based on the good interval index (good_tstart, good_tend) and bad antennas (badants)
+    shared by MetaAntFlagger and AntFlagSummary
+    """
+    def check_goods(self, mjds):
+        """check if the data is good for an array of mjds, mjds out of the metadata range are bad"""
+        mjds = np.atleast_1d(np.asarray(mjds, dtype=float))
+        idx = np.searchsorted(self.good_tstart, mjds, side="right") - 1
+        good = idx >= 0
+        good[good] = mjds[good] < self.good_tend[idx[good]]
+        return good
+
+    def _check_good(self, mjd):
+        """check if the data is flagged with a given mjd"""
+        return bool(self.check_goods(mjd)[0])
+
+    def good_durations(self, tstarts, tends):
+        """total good time (in days) between tstarts and tends, for arrays of time ranges"""
+        tstarts = np.atleast_1d(np.asarray(tstarts, dtype=float))
+        tends = np.atleast_1d(np.asarray(tends, dtype=float))
+        if len(self.good_tstart) == 0: return np.zeros(np.broadcast(tstarts, tends).shape)
+        lengths = self.good_tend - self.good_tstart
+        cumlengths = np.concatenate([[0.], np.cumsum(lengths)])
+
+        def _cumgood(t):
+            """total good time before t"""
+            idx = np.searchsorted(self.good_tstart, t, side="right") - 1
+            safeidx = np.maximum(idx, 0)
+            partial = np.clip(t - self.good_tstart[safeidx], 0, lengths[safeidx])
+            return np.where(idx >= 0, cumlengths[safeidx] + partial, 0.)
+
+        return np.maximum(_cumgood(tends) - _cumgood(tstarts), 0.)
+
+    def find_startmjds(self, mjds):
+        """
+        work out the start mjd for an array of mjds in one go
+        0 for good mjds, first good mjd after it for bad ones, None if there is no good data afterwards
+        """
+        mjds = np.atleast_1d(np.asarray(mjds, dtype=float))
+        good = self.check_goods(mjds)
+        nextidx = np.searchsorted(self.good_tstart, mjds, side="right")
+        startmjds = []
+        for isgood, inext in zip(good, nextidx):
+            if isgood: startmjds.append(0) # 0 should be fine, or any small number
+            elif inext < len(self.good_tstart): startmjds.append(self.good_tstart[inext])
+            else: startmjds.append(None)
+        return startmjds
+
+    def find_startmjd(self, mjd):
+        """
+        work out the start mjd with a given mjd
+        """
+        startmjd = self.find_startmjds(mjd)[0]
+        if startmjd != 0: log.info(f"mjd - {mjd} is not a good startmjd... found {startmjd}")
+        return startmjd
+
+    def _run(self, sbid, dumpfname=None):
+        ### this _run function is used for scan specified tstart
+        # self.get_stats()
+
+        startmjd = {}
+        nogoods = [] # scans with uvfits files but no good data afterwards
+        uvfitspaths = {}
+        scheddir = SchedDir(sbid)
+        for scan in scheddir.scans:
+            scandir = ScanDir(sbid=scheddir.sbid, scan=scan)
+            uvfitspath = scandir.uvfits_paths[0]
+            if not os.path.exists(uvfitspath):
+                log.info(f"{uvfitspath} not found... use None to continue...")
+                startmjd[scan] = str(None)
+                continue
+            uvfitspaths[scan] = uvfitspath
+
+        ### read headers for all scans concurrently
+        headers = read_uvfits_headers(uvfitspaths.values())
+        uvfitsmjds = {}
+        for scan, uvfitspath in uvfitspaths.items():
+            if headers[uvfitspath] is None:
+                startmjd[scan] = str(None)
+                continue
+            uvfitsmjds[scan] = uvfits_mjd_start(headers[uvfitspath])
+
+        ### look up start mjds for all scans in one go
+        scans = list(uvfitsmjds)
+        for scan, mjd in zip(scans, self.find_startmjds([uvfitsmjds[scan] for scan in scans])):
+            startmjd[scan] = str(mjd)
+            if mjd is None: nogoods.append(scan)
+        startmjd = {scan: startmjd[scan] for scan in scheddir.scans}
+
+        self.startmjds = startmjd # store startmjd values for prepare skadi
+        self.nogoods = nogoods
+
+        metainfo = dict(
+            startmjd = startmjd,
+            flagants = self.badants.__str__()
+        )
+
+        if dumpfname is not None:
+            log.info(f"dumping metadata information to {dumpfname}")
+            with open(dumpfname, "w") as fp:
+                json.dump(metainfo, fp, indent=4)
+
+        return metainfo
+
+class AntFlagSummary(GoodIntervalIndex):
+    """
+    antenna flagging summary for a given sbid - bad antennas, good interval index and per-scan start mjds
+
+    it is keyed by the hash of the metadata file and the bad antenna fraction,
+    so that it can be reused until any of them changes.
+    the size and modification time of the metadata file (metastamp) are stored as well,
+    so that the file only needs to be hashed again when they change
+
+    scans in `nogoods` have uvfits files but no good data, their start mjds are None but final
+    """
+    def __init__(
+        self, badants, good_tstart, good_tend, startmjds=None, 
+        metahash=None, fraction=None, metastamp=None, nogoods=None,
+    ):
+        self.badants = list(badants)
+        self.good_tstart = np.array(good_tstart, dtype=float)
+        self.good_tend = np.array(good_tend, dtype=float)
+        self.startmjds = startmjds if startmjds is not None else {}
+        self.metahash = metahash
+        self.fraction = fraction
+        self.metastamp = metastamp
+        self.nogoods = list(nogoods) if nogoods is not None else []
+
+    @classmethod
+    def from_flagger(cls, metaantflag, metahash=None, fraction=None, metastamp=None):
+        return cls(
+            badants=[int(ia) for ia in metaantflag.badants],
+            good_tstart=metaantflag.good_tstart, good_tend=metaantflag.good_tend,
+            startmjds=getattr(metaantflag, "startmjds", None),
+            metahash=metahash, fraction=fraction, metastamp=metastamp,
+            nogoods=getattr(metaantflag, "nogoods", None),
+        )
+
+    @property
+    def pending_scans(self):
+        """scans without start mjds because uvfits files were not available when the summary was built"""
+        return [
+            scan for scan, mjd in self.startmjds.items() 
+            if mjd == str(None) and scan not in self.nogoods
+        ]
+
+    def match(self, metahash, fraction):
+        return self.metahash == metahash and self.fraction == fraction
+
+    @classmethod
+    def load(cls, fname):
+        with open(fname) as fp:
+            summary = json.load(fp)
+        if summary.get("version") != ANTFLAG_SUMMARY_VERSION:
+            raise ValueError(f"unsupported antflag summary version {summary.get('version')}")
+        return cls(
+            badants=summary["badants"], 
+            good_tstart=summary["good_tstart"], good_tend=summary["good_tend"],
+            startmjds=summary["startmjds"], 
+            metahash=summary["metahash"], fraction=summary["fraction"],
+            metastamp=summary["metastamp"], nogoods=summary["nogoods"],
+        )
+
+    def dump(self, fname):
+        summary = dict(
+            version=ANTFLAG_SUMMARY_VERSION, 
+            metahash=self.metahash, fraction=self.fraction,
+            badants=self.badants, 
+            good_tstart=self.good_tstart.tolist(), good_tend=self.good_tend.tolist(),
+            startmjds=self.startmjds,
+            metastamp=self.metastamp, nogoods=self.nogoods,
+        )
+        tmpname = f"{fname}.{os.getpid()}.tmp"
+        with open(tmpname, "w") as fp:
+            json.dump(summary, fp)
+        os.replace(tmpname, fname)
+
 class MetaManager:
     """
     class to manage all metadata files
     """
-    def __init__(self, obssbid, frac=0.2):
+    def __init__(self, obssbid, frac=0.2, stream=False):
         self.obssbid = _format_sbid(obssbid, padding=True)
         ### get head node folder for this sbid
         self.workdir = f"/CRACO/DATA_00/craco/{self.obssbid}"
         self.metaname = f"{_format_sbid(obssbid, padding=False)}.json.gz"
         self.badfrac = frac # determine the fraction of bad antenna
+        self.stream = stream # parse metadata file incrementally
 
     ### get meta data and save it to correct place
     def _get_skadi_metadata(self, overwrite=False):
@@ -92,16 +345,61 @@ class MetaManager:
         log.info(f"copying metadata {self.metaname} from tethys")
         os.system(scpcmd)
 
-    def _get_flagger_info(self, ):
+    @property
+    def summarypath(self):
+        return f"{self.workdir}/{self.obssbid}.antflag.summary.json"
+
+    def _load_flagger_summary(self, metafile, metastamp):
+        """load antflag summary if it was built from the same metadata file and fraction, otherwise None"""
+        if not os.path.exists(self.summarypath): return None
+        try: summary = AntFlagSummary.load(self.summarypath)
+        except Exception as error:
+            log.info(f"cannot load antflag summary {self.summarypath}... rebuild it... error - {error}")
+            return None
+        ### only hash the metadata file if it has been touched since the summary was built
+        if summary.metastamp == metastamp: metahash = summary.metahash
+        else: metahash = hash_metafile(metafile)
+        if not summary.match(metahash, self.badfrac):
+            log.info(f"metadata or fraction changed since {self.summarypath} was built... rebuild it...")
+            return None
+        return summary
+
+    def _get_flagger_info(self, refresh=False):
+        metafile = f"{self.workdir}/{self.metaname}"
+        dumpfname = f"{self.workdir}/{self.obssbid}.antflag.json"
+        metastamp = metafile_stamp(metafile)
+
+        summary = None if refresh else self._load_flagger_summary(metafile, metastamp)
+        if summary is not None:
+            log.info(f"loading antflag summary from {self.summarypath}")
+            self.metaantflag = summary
+            ### new scans, or scans without uvfits files when the summary was built - only need uvfits headers to update
+            scanchanged = set(SchedDir(self.obssbid).scans) != set(summary.startmjds)
+            if scanchanged or summary.pending_scans or not os.path.exists(dumpfname):
+                summary._run(self.obssbid, dumpfname)
+                summary.metastamp = metastamp
+                summary.dump(self.summarypath)
+            elif summary.metastamp != metastamp:
+                ### same content, record the new stamp so that we don't hash it again
+                summary.metastamp = metastamp
+                summary.dump(self.summarypath)
+            return
+
         self.metaantflag = MetaAntFlagger(
-            f"{self.workdir}/{self.metaname}", fraction=self.badfrac,
+            metafile, fraction=self.badfrac, stream=self.stream,
         )
 
-        dumpfname = f"{self.workdir}/{self.obssbid}.antflag.json"
         # self.metaantflag.run(dumpfname)
         self.metaantflag._run(self.obssbid, dumpfname)
 
         ### note there are information useful in this self.metaantflag
+        try:
+            AntFlagSummary.from_flagger(
+                self.metaantflag, metahash=hash_metafile(metafile), 
+                fraction=self.badfrac, metastamp=metastamp,
+            ).dump(self.summarypath)
+        except Exception as error:
+            log.warning(f"cannot save antflag summary to {self.summarypath}... error - {error}")
 
     def run(self, skadi=True):
         if skadi: 
@@ -110,24 +408,36 @@ class MetaManager:
             self._get_tethys_metadata(overwrite=False)
         self._get_flagger_info()
 
-class MetaAntFlagger:
+class MetaAntFlagger(GoodIntervalIndex):
     
-    def __init__(self, metafile, sbid=None, fraction=0.2):
+    def __init__(self, metafile, sbid=None, fraction=0.2, stream=False):
+        """
+        if `stream` is True, metadata file is parsed incrementally, 
+        and only flag counts and runs of the number of flagged antennas are kept (no self.meta and self.antflags)
+        """
         log.info(f"loading metadata file from {metafile}")
-        self.meta = MetadataFile(metafile)
-        self.antflags = self.meta.antflags
+        if stream and ijson is None:
+            log.warning("ijson is not available... load the whole metadata file instead...")
+            stream = False
+        self.stream = stream
+
+        if self.stream:
+            self.meta = None; self.antflags = None
+            self.nt, self.flagantsum, self.runs = stream_meta_flags(metafile)
+            self.na = len(self.flagantsum)
+        else:
+            self.meta = MetadataFile(metafile)
+            self.antflags = self.meta.antflags
+            ### get basic information
+            self._get_info()
+            self.flagantsum = self.antflags.sum(axis=0)
+            self.runs = _runs_from_counts(self.meta.times.value, self.antflags.sum(axis=1))
         
-        ### get basic information
-        self._get_info()
         self.badants = self._find_bad_ant(fraction=fraction)
         ### make it to a list
         self.badants = list(self.badants + 1)
         log.info(f"finding {len(self.badants)} bad antennas...")
         self._find_good_ranges()
-
-        ### get flag interp
-        self._get_flag_interp()
-        
         
     def _get_info(self):
         nt, na = self.antflags.shape
@@ -138,49 +448,33 @@ class MetaAntFlagger:
         """
         the antenna will be flagged if 80% of the time, it is bad
         """
-        flagantsum = self.antflags.sum(axis=0)
+        flagantsum = self.flagantsum
         # work out threshold automatically
         flagmed = np.median(flagantsum)
         return np.where(flagantsum >= flagmed + fraction * self.nt)[0]
     
     def _find_good_ranges(self):
-        flagtimesum = self.antflags.sum(axis=1) - len(self.badants)
-        good_bool = flagtimesum <= 0
-        self.good_bool = good_bool
-        self.good_ranges = find_true_range(good_bool)
+        self.runs["good"] = self.runs["nflag"] - len(self.badants) <= 0
+        if not self.stream:
+            flagtimesum = self.antflags.sum(axis=1) - len(self.badants)
+            self.good_bool = flagtimesum <= 0
+
+        ### merge consecutive good runs - sample index and time ranges
+        goodruns = np.where(self.runs["good"])[0]
+        groups = np.split(goodruns, np.where(np.diff(goodruns) > 1)[0] + 1)
+        groups = [group for group in groups if len(group) > 0]
+        self.good_ranges = [(self.runs["start"][g[0]], self.runs["end"][g[-1]]) for g in groups]
+        self.good_time_ranges = [(self.runs["tstart"][g[0]], self.runs["tlast"][g[-1]]) for g in groups]
+
+        ### interval index - data is good for good_tstart[i] <= mjd < good_tend[i]
+        ### a good interval lasts until the first sample of the following bad run
+        nruns = len(self.runs["nflag"])
+        lastend = np.nextafter(self.runs["tlast"][-1], np.inf)
+        self.good_tstart = np.array([self.runs["tstart"][g[0]] for g in groups], dtype=float)
+        self.good_tend = np.array([
+            self.runs["tstart"][g[-1] + 1] if g[-1] + 1 < nruns else lastend for g in groups
+        ], dtype=float)
 
-    # @property
-    def _get_flag_interp(self):
-        """
-        self.meta.times.value - the times in the metadata file
-        self.good_bool - corresponding flag values
-        """
-        self.flag_interp = interp1d(
-            self.meta.times.value, self.good_bool,
-            kind="previous", axis=0, bounds_error=True, copy=False,
-        )
-
-    def _check_good(self, mjd):
-        """check if the data is flagged with a given mjd"""
-        try:
-            return self.flag_interp(mjd) == 1.
-        except:
-            log.info(f"error raised when interpolating data... mjd = {mjd}")
-            return False
-
-    def find_startmjd(self, mjd):
-        """
-        work out the start mjd with a given mjd
-        """
-        if self._check_good(mjd): return 0 # 0 should be fine, or any small number
-
-        log.info(f"mjd - {mjd} is not a good startmjd... finding the good one")
-        times = self.meta.times.value
-        bools = self.good_bool
-        for i in np.where(times > mjd)[0]:
-            if bools[i]: return times[i]
-        return None
-        
     ### get range of time
     def get_start_end_time(self):
         if len(self.good_ranges) == 0:
@@ -188,10 +482,11 @@ class MetaAntFlagger:
             return None, None
         ### get the best ranges
         ranges_time = np.array([t[1] - t[0] for t in self.good_ranges])
-        best_start, best_end = self.good_ranges[np.argmax(ranges_time)]
+        ibest = np.argmax(ranges_time)
+        best_start, best_end = self.good_ranges[ibest]
         log.info(f"the best range found... {best_start} ~ {best_end}, it lasted for {best_end - best_start} hardware samples...")
         
-        return [self.meta.times[best_start].value, self.meta.times[best_end-1].value]
+        return list(self.good_time_ranges[ibest])
 
     # def get_flag_ant(self):
     #     return list(self.badants + 1)
@@ -215,37 +510,6 @@ class MetaAntFlagger:
         with open(dumpfname, "w") as fp:
             json.dump(metainfo, fp, indent=4)
 
-    def _run(self, sbid, dumpfname=None):
-        ### this _run function is used for scan specified tstart
-        # self.get_stats()
-
-        startmjd = {}
-        scheddir = SchedDir(sbid)
-        for scan in scheddir.scans:
-            scandir = ScanDir(sbid=scheddir.sbid, scan=scan)
-            uvfitspath = scandir.uvfits_paths[0]
-            if not os.path.exists(uvfitspath):
-                log.info(f"{uvfitspath} not found... use None to continue...")
-                startmjd[scan] = str(None)
-                continue
-            
-            uvfitsmjd = get_mjd_start_from_uvfits_header(uvfitspath)
-            startmjd[scan] = str(self.find_startmjd(uvfitsmjd))
-
-        self.startmjds = startmjd # store startmjd values for prepare skadi
-
-        metainfo = dict(
-            startmjd = startmjd,
-            flagants = self.badants.__str__()
-        )
-
-        if dumpfname is not None:
-            log.info(f"dumping metadata information to {dumpfname}")
-            with open(dumpfname, "w") as fp:
-                json.dump(metainfo, fp, indent=4)
-
-        return metainfo
-            
 def main():
     from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
     parser = ArgumentParser(
@@ -255,15 +519,18 @@ def main():
     parser.add_argument("-meta", "--meta", type=str, help="Path to the meta data file (.json.gz)", default=None)
     parser.add_argument("-dump", "--dump", type=str, help="Path to save the information", default="./metainfo.json")
     parser.add_argument("-frac", "--frac", type=float, help="Fractional of bad interval to be considered as a bad antenna", default=0.8)
+    parser.add_argument("-stream", "--stream", help="parse the metadata file incrementally (needs ijson)", default=False, action="store_true")
 
     values = parser.parse_args()
 
     metaflag = MetaAntFlagger(
         metafile = values.meta,
         fraction = values.frac,
+        stream = values.stream,
     )
     metaflag.run(values.dump)
 
 
 if __name__ == "__main__":
     main()
+
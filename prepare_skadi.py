@@ -6,16 +6,19 @@ log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 import glob
+import json
 import os
-import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from craft.cmdline import strrange
 from craco.datadirs import SchedDir, ScanDir
 
 from metaflag import MetaAntFlagger, MetaManager
+from uvfitsinfo import read_uvfits_header, read_uvfits_headers, stat_uvfits, uvfits_nchan
+from tspqueue import get_queue_load, list_tsp_jobs, plan_queue_placement, submit_tsp_jobs
 import craco_cfg as cfg
-import subprocess
 
 from auto_sched import push_sbid_execution, update_table_single_entry
 
@@ -59,18 +62,57 @@ def make_dir(path):
         log.info(f"making new directories... {path}")
         os.makedirs(path)
 
-def get_nchan_from_uvfits_header(fname, hdr_size = 16384):
-    with open(fname, 'rb') as o:
-        raw_h = o.read(hdr_size)
-    pattern = "NAXIS4\s*=\s*(\d+.\d+)\s*"
-    matches = re.findall(pattern, str(raw_h))
-    if len(matches) !=1:
-        raise RuntimeError(f"Something went wrong when looking for nchan in the header, I used this regex - {pattern}")
+def get_nchan_from_uvfits_header(fname):
+    return uvfits_nchan(read_uvfits_header(fname))
 
-    nchan = int(float(matches[0]))
-    if nchan < 300: return nchan
-    raise RuntimeError(f"I found a really unexpected value of nchan from uvfits header - {nchan}")
 
+SEARCH_SCRIPT = "./do_search_and_summarise.sh"
+
+def _scan_uvfits_paths(scan):
+    """all uvfits paths for a given scan (/data/craco/craco/SB0xxxxx/scans/??/??????????????)"""
+    scanparts = scan.rstrip("/").split("/")
+    return ScanDir(sbid=scanparts[-4], scan="/".join(scanparts[-2:])).uvfits_paths
+
+def estimate_scan_costs(scans, nworkers=16):
+    """
+    estimate the cost of running the pipeline for a list of scans (/data/craco/craco/SB0xxxxx/scans/??/??????????????)
+    it scales with the total size of uvfits files and the number of channels (for ndm), in GB x nchan / 288
+    all uvfits files are stat-ed in one go, and only the header of the first existing beam is read for each scan
+
+    return a dictionary of cost for each scan, None if the uvfits files cannot be located
+    """
+    scans = list(dict.fromkeys(scans))
+    if len(scans) == 0: return {}
+    def _paths(scan):
+        try: return _scan_uvfits_paths(scan)
+        except Exception as error:
+            log.warning(f"cannot locate uvfits files for {scan}... error - {error}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=min(nworkers, len(scans))) as executor:
+        scanpaths = dict(zip(scans, executor.map(_paths, scans)))
+    stats = stat_uvfits(
+        [path for paths in scanpaths.values() if paths for path in paths], nworkers=nworkers
+    )
+    existing = {
+        scan: [path for path in paths if stats.get(path) is not None]
+        for scan, paths in scanpaths.items() if paths is not None
+    }
+    headers = read_uvfits_headers([paths[0] for paths in existing.values() if paths], nworkers=nworkers)
+
+    costs = {scan: None for scan in scans}
+    for scan, paths in existing.items():
+        if len(paths) == 0: costs[scan] = 0.; continue
+        size = sum(stats[path][0] for path in paths) / 1024 ** 3
+        try: nchan = uvfits_nchan(headers[paths[0]])
+        except Exception: nchan = 288
+        costs[scan] = size * nchan / 288
+    return costs
+
+def _tsp_job_scan(tokens):
+    """scan in the command of a pipeline job in the tsp queue, None for other jobs"""
+    if SEARCH_SCRIPT not in tokens: return None
+    return tokens[tokens.index(SEARCH_SCRIPT) + 1]
 
 ####### this part is used to make symbolic link to the calibration #######
 '''
@@ -89,9 +131,10 @@ class CalLinker:
         obssbid: int
         calsbid: int
     """
-    def __init__(self, obssbid, calsbid):
+    def __init__(self, obssbid, calsbid, nodes=range(0, 19)):
         self.obssbid = _format_sbid(obssbid, padding=True)
         self.calsbid = _format_sbid(calsbid, padding=True)
+        self.nodes = list(nodes)
 
     def _get_runcal_dir(self, node):
         return f"/CRACO/DATA_{node:0>2}/craco/{self.obssbid}/cal"
@@ -99,21 +142,58 @@ class CalLinker:
     def _get_cal_dir(self):
         return f"/CRACO/DATA_00/craco/calibration/{self.calsbid}"
 
+    def _for_all_nodes(self, func):
+        """run func(node) for all nodes concurrently, return a dictionary of (success, message) for each node"""
+        def _run(node):
+            try: return func(node)
+            except Exception as error: return False, str(error)
+
+        with ThreadPoolExecutor(max_workers=len(self.nodes)) as executor:
+            results = list(executor.map(_run, self.nodes))
+        return dict(zip(self.nodes, results))
+
+    def _report(self, action, results):
+        failed = {node: msg for node, (success, msg) in results.items() if not success}
+        log.info(f"{action} for {len(results) - len(failed)}/{len(results)} nodes...")
+        for node, msg in failed.items():
+            log.warning(f"{action} failed for node{node}... {msg}")
+        return results
+
     def _clean_cal_node(self, node):
         """
         clean up calibration directory if there is something exists
         """
         runcal_dir = self._get_runcal_dir(node)
-        if os.path.exists(runcal_dir):
+        if os.path.islink(runcal_dir) or os.path.isfile(runcal_dir):
             log.info(f"find existing calibration link in {runcal_dir}... removing...")
-            rmcmd = f"rm -r {runcal_dir}"
-            os.system(rmcmd)
+            os.remove(runcal_dir)
+        elif os.path.isdir(runcal_dir):
+            log.info(f"find existing calibration directory in {runcal_dir}... removing...")
+            shutil.rmtree(runcal_dir)
+        return True, "cleaned"
 
     def clean_cal(self):
         log.info(f"checking existing calibration link for {self.obssbid}...")
-        for node in range(0, 19):
+        return self._report("cleaning calibration link", self._for_all_nodes(self._clean_cal_node))
+
+    def _link_cal_node(self, node, cal_dir):
+        """
+        make a symbolic link for a given node, an existing link is replaced in one step (rename over it),
+        so that there is always a cal link for jobs already in the queue
+        """
+        runcal_dir = self._get_runcal_dir(node)
+        if not os.path.isdir(os.path.dirname(runcal_dir)):
+            return False, f"{os.path.dirname(runcal_dir)} does not exist"
+        if os.path.isdir(runcal_dir) and not os.path.islink(runcal_dir):
+            ### a real directory cannot be replaced by a rename
             self._clean_cal_node(node)
 
+        tmplink = f"{runcal_dir}.{os.getpid()}.tmp"
+        if os.path.lexists(tmplink): os.remove(tmplink)
+        os.symlink(cal_dir, tmplink)
+        os.replace(tmplink, runcal_dir)
+        return True, f"linked to {cal_dir}"
+
     def link_cal(self):
         cal_dir = self._get_cal_dir()
         log.info(f"check if calibration solution existing under {cal_dir}...")
@@ -121,16 +201,15 @@ class CalLinker:
             log.critical(f"no calibration found for {self.calsbid}... aborted")
             raise ValueError(f"no calibration solution found for {self.calsbid}...")
 
-        for node in range(0, 19):
-            # make the link in the headnode to keep track everything
-            log.debug(f"linking calibration solution for node{node}...")
-            lncmd = f"ln -s {cal_dir} {self._get_runcal_dir(node)}"
-            log.info(f"executing {lncmd}...")
-            os.system(lncmd)
+        log.info(f"linking calibration solution {cal_dir} for {self.obssbid}...")
+        return self._report(
+            "linking calibration solution", 
+            self._for_all_nodes(lambda node: self._link_cal_node(node, cal_dir)),
+        )
     
     def run(self):
-        self.clean_cal()
-        self.link_cal()
+        ### existing links are replaced in link_cal, no need to clean them up first
+        return self.link_cal()
 
 
 class ExecuteManager:
@@ -140,7 +219,7 @@ class ExecuteManager:
     ### can we include calibration here as well?
     def __init__(self, values):
         self.callinker = CalLinker(values.obssbid, values.calsbid)
-        self.metamanage = MetaManager(values.obssbid)
+        self.metamanage = MetaManager(values.obssbid, stream=cfg.STREAM_METADATA)
         self.obssbid = _format_sbid(values.obssbid, padding=True)
         self.runname = values.runname
 
@@ -166,6 +245,8 @@ class ExecuteManager:
         self.__get_all_scans() #these are all $indir s
         self.__get_flag_ant()
         self.__get_start_mjd()
+        if not isinstance(cfg.NDM, (int, float)):
+            self.__prefetch_headers()
 
     def __get_all_scans(self, ):
         scanpattern = f"/data/craco/craco/{self.obssbid}/scans/??/??????????????"
@@ -185,17 +266,30 @@ class ExecuteManager:
         # self.startmjd = self.metamanage.metaantflag.trange[0]
         self.startmjds = self.metamanage.metaantflag.startmjds # it is a dictionary
 
+    def __get_scan_uvfits(self, scan):
+        scandir = ScanDir(sbid=self.obssbid, scan=scan)
+        return scandir.uvfits_paths[0]
+
+    def __prefetch_headers(self, ):
+        """read uvfits headers for all scans in one go, they are cached for __get_scan_nchan"""
+        uvfitspaths = []
+        for scan in self.allscans:
+            shortscan = "/".join(scan.split("/")[-2:])
+            try: uvfitspaths.append(self.__get_scan_uvfits(shortscan))
+            except Exception: continue
+        read_uvfits_headers(uvfitspaths)
+
     def __get_scan_nchan(self, scan):
         try:
-            scandir = ScanDir(sbid=self.obssbid, scan=scan)
-            uvfitspath = scandir.uvfits_paths[0]
+            uvfitspath = self.__get_scan_uvfits(scan)
         except NotImplementedError:
             log.warning(f"no rank file found for scan {scan}... use 288 instead...")
             return 288
         try:
             nchan = get_nchan_from_uvfits_header(uvfitspath)
             return nchan
-        except:
+        except Exception as error:
+            log.warning(f"cannot get nchan from {uvfitspath}... use 288 instead... error - {error}")
             return 288
 
     def format_scanrun_name(self, scan, ):
@@ -282,6 +376,56 @@ logpath=$outdir/{scanfname}.$trun.log
 
         return f"{self.shelldir}/{shfname}"
 
+    def _get_queue_loads(self, nqueues):
+        """
+        estimated remaining work in each queue, zero if the queue cannot be checked
+        costs of all scans in all queues are estimated in one go
+        """
+        def _list_jobs(iqueue):
+            try: return list_tsp_jobs(f"{cfg.PIPE_RUN_TS_SOCKET}/{iqueue}")
+            except Exception as error:
+                log.warning(f"cannot check queue {iqueue}... assume it is empty... error - {error}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=nqueues) as executor:
+            queuejobs = list(executor.map(_list_jobs, range(nqueues)))
+
+        scans = [
+            _tsp_job_scan(job["tokens"]) for jobs in queuejobs if jobs for job in jobs
+        ]
+        scancosts = estimate_scan_costs([scan for scan in scans if scan is not None])
+        def _job_cost(tokens):
+            scan = _tsp_job_scan(tokens)
+            if scan is None: return None
+            return scancosts.get(scan)
+
+        loads = []
+        for iqueue, jobs in enumerate(queuejobs):
+            if jobs is None: loads.append(0.); continue
+            njob, load = get_queue_load(None, _job_cost, jobs=jobs)
+            log.info(f"{njob} jobs unfinished in queue {iqueue} - estimated load {load:.1f}")
+            loads.append(load)
+        return loads
+
+    def plan_queues(self, nqueues):
+        """
+        decide which queue (i.e., which pair of FPGA cards) to use for each scan,
+        based on the existing load in each queue and the cost of each scan
+        """
+        if nqueues == 1: return [0] * len(self.allscans)
+        loads = self._get_queue_loads(nqueues)
+        scancosts = estimate_scan_costs(self.allscans)
+        costs = []
+        for scan in self.allscans:
+            if scancosts[scan] is None:
+                log.warning(f"cannot estimate the cost for {scan}... use 1 instead...")
+                costs.append(1.)
+            else: costs.append(scancosts[scan])
+        placement = plan_queue_placement(costs, loads, offset=int(self.values.obssbid) % nqueues)
+        for scan, cost, iqueue in zip(self.allscans, costs, placement):
+            log.info(f"{scan} (cost {cost:.1f}) will be running on queue {iqueue}")
+        return placement
+
     def run(self, ):
         self.callinker.run()
         self.metamanage.run()
@@ -290,47 +434,60 @@ logpath=$outdir/{scanfname}.$trun.log
         self.shellscripts = []
 
         nqueues = self.values.nqueues
-        environments = []
-        commands = []
-        nscans = len(self.allscans)
-        for iscan, scan in enumerate(self.allscans):
-            if nscans > 1: 
-                iqueue = iscan % nqueues
-            else:
-                iqueue = int(self.values.obssbid) % nqueues
+        placement = self.plan_queues(nqueues)
+
+        ### write all scripts first, environment is the same for all scans in a queue
+        queue_environments = {}
+        self.tspjobs = []
+        for scan, iqueue in zip(self.allscans, placement):
             shellpath = self.write_bash_scan(scan, dryrun=self.values.dryrun) # note scan is /data/craco/craco/SB0xxxxx/...
-            
-            ### todo - decide which queue to use based on the current queue value
-            environments.append({
-                'TS_SOCKET':f'{cfg.PIPE_RUN_TS_SOCKET}/{iqueue}',
-                'TS_ONFINISH': f"{cfg.PIPE_TS_ONFINISH}",
-                'START_CARD':str(iqueue*2),
-                'RUNNAME':self.runname
-            })
-            
-            searchcmd = f'./do_search_and_summarise.sh {scan} {shellpath} {self.runname}'
-            if self.values.dryrun:
-                commands.append(f"echo `{searchcmd}`; sleep 10")
-            else:
-                commands.append(searchcmd)
-            
+            if iqueue not in queue_environments:
+                queue_environments[iqueue] = {
+                    'TS_ONFINISH': f"{cfg.PIPE_TS_ONFINISH}",
+                    'START_CARD':str(iqueue*2),
+                    'RUNNAME':self.runname
+                }
+            self.tspjobs.append(dict(
+                scan=scan, script=shellpath, queue=iqueue,
+                socket=f'{cfg.PIPE_RUN_TS_SOCKET}/{iqueue}',
+                argv=[SEARCH_SCRIPT, scan, shellpath, self.runname],
+                environment=queue_environments[iqueue],
+            ))
             self.shellscripts.append(shellpath)
 
+        if self.values.dryrun:
+            for job in self.tspjobs:
+                log.info(f"dryrun - tsp {' '.join(job['argv'])} on {job['socket']} with environment {job['environment']}")
+            return self.tspjobs
+
         log.info("making bash files executable...")
-        for i in self.shellscripts:
-            chmodcmd = f"chmod +x {i}"
-            os.system(chmodcmd)
-
-        tspcmds = [f"tsp {cmd}" for cmd in commands]
-
-        log.info("executing bash scripts...")
-        for tspcmd, environment in zip(tspcmds, environments):
-            log.info(f"running {tspcmd} with evironment {environment}")
-            if not self.values.dryrun:
-                ecopy = os.environ.copy()
-                ecopy.update(environment)
-                p = subprocess.run([tspcmd], shell=True, capture_output=True, text=True, env=ecopy)
-                tsp_jobid = int(p.stdout.strip())
+        for shellpath in self.shellscripts:
+            os.chmod(shellpath, os.stat(shellpath).st_mode | 0o111)
+
+        log.info(f"submitting {len(self.tspjobs)} jobs to {len(queue_environments)} queues...")
+        submit_tsp_jobs(self.tspjobs)
+        for job in self.tspjobs:
+            if job["jobid"] is None:
+                log.error(f"failed to submit {job['scan']} to queue {job['queue']}... {job['error']}")
+            else:
+                log.info(f"{job['scan']} submitted to queue {job['queue']} - job id {job['jobid']}")
+
+        self._dump_tspjobs()
+        return self.tspjobs
+
+    def _dump_tspjobs(self, ):
+        """keep a record of submitted tsp jobs for later tracking"""
+        manifest = f"{self.shelldir}/tspjobs.{self.runname}.{get_timestamp()}.json"
+        records = [
+            {key: job[key] for key in ("scan", "script", "queue", "socket", "jobid", "error")}
+            for job in self.tspjobs
+        ]
+        try:
+            with open(manifest, "w") as fp:
+                json.dump(records, fp, indent=4)
+            log.info(f"tsp job ids saved to {manifest}")
+        except Exception as error:
+            log.warning(f"cannot save tsp job ids to {manifest}... error - {error}")
 
 def main():
     from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
@@ -9,14 +9,20 @@ import os
 import glob
 import numpy as np
 import subprocess
+import shlex
 
-from craco.datadirs import SchedDir, ScanDir
+from craco.datadirs import SchedDir
 
 # from prepare_skadi import MetaManager
 from metaflag import MetaAntFlagger, MetaManager
+from uvfitsinfo import scan_uvfits_summary, read_uvfits_headers, uvfits_mjd_start
 import craco_cfg as cfg
 
-from auto_sched import push_sbid_calibration
+from auto_sched import push_sbid_calibration, CracoSchedBlock
+
+### weight of calibration rank (see `CracoSchedBlock.rank_calibration`) when scoring scans
+SCAN_RANK_WEIGHT = {0: 0.1, 1: 0.5, 2: 1., 3: 1.}
+COPYCAL_PATH = "/CRACO/SOFTWARE/craco/wan342/Software/craco_run/copycal.py"
 
 def _format_sbid(sbid, padding=True):
     "perform formatting for the sbid"
@@ -41,6 +47,10 @@ class CalibManager:
     def __get_all_scans(self, ):
         scanpattern = f"/data/craco/craco/{self.calsbid}/scans/??/??????????????"
         scans = sorted(glob.glob(scanpattern))
+        ### size all beams of all scans at once
+        self.scansummary = scan_uvfits_summary(
+            self.calsbid, ["/".join(scan.split("/")[-2:]) for scan in scans]
+        )
         self.allscans = [scan for scan in scans if self.__filter_scan(scan)]
         # self.allscans = sorted(glob.glob(scanpattern))
 
@@ -49,33 +59,93 @@ class CalibManager:
         based on the scan, check whether there are 36 uvfits file...
         """
         scan = "/".join(scan.split("/")[-2:])
-        try:
-            scandir = ScanDir(sbid=self.calsbid, scan=scan)
-            uvfits_exists = scandir.uvfits_paths_exists
-        except NotImplementedError:
+        summary = self.scansummary[scan]
+        if summary["error"] is not None:
             log.warning(f"no rank file for this scan - {scan}...")
             return False
 
-        if len(uvfits_exists) < 36: 
+        if not summary["complete"]: 
             log.warning(f"there are less than 36 uvfits file in {scan}")
             return False # need all beams exists
 
-        uvfits_size = np.array([os.path.getsize(path) / (1024 ** 3) for path in uvfits_exists])
-        if np.any(uvfits_size < 3): 
+        if summary["min_size"] < 3: 
             log.warning(f"the file size is too small for {scan}...")
             return False # if the size is too small aborted..
         return True
 
     def _get_meta(self):
-        metamanager = MetaManager(self.values.calsbid)
+        metamanager = MetaManager(self.values.calsbid, stream=cfg.STREAM_METADATA)
         metamanager._get_tethys_metadata()
         metamanager._get_flagger_info()
         log.info("loading flag information from metadata...")
+        self.metaantflag = metamanager.metaantflag
         self.startmjds = metamanager.metaantflag.startmjds
 
+    def _score_scans(self):
+        """
+        score all scans by the number of usable samples, i.e., 
+        (fraction of the scan in good intervals from metadata) x (uvfits size per beam) x (weight of calibration rank)
+        """
+        shortscans = ["/".join(scan.split("/")[-2:]) for scan in self.allscans]
+        sizes = np.array([self.scansummary[scan]["min_size"] for scan in shortscans])
+
+        ### start of each scan from uvfits header, end of the scan is the start of the next one (by start time)
+        ### all scans are used here, including those filtered out, otherwise their time goes to the scan before them
+        firstpaths = {
+            scan: summary["paths"][0] for scan, summary in self.scansummary.items() if summary["paths"]
+        }
+        headers = read_uvfits_headers(firstpaths.values())
+        allstarts = {}
+        for scan, path in firstpaths.items():
+            try: allstarts[scan] = uvfits_mjd_start(headers[path])
+            except Exception: continue
+        sortedstarts = np.sort(list(allstarts.values()))
+
+        tstarts = np.array([allstarts.get(scan, np.nan) for scan in shortscans])
+        inext = np.searchsorted(sortedstarts, tstarts, side="right")
+        tends = np.full(len(shortscans), np.nan)
+        hasnext = np.isfinite(tstarts) & (inext < len(sortedstarts))
+        tends[hasnext] = sortedstarts[inext[hasnext]]
+        ### otherwise work it out from the size
+        daypergb = (tends - tstarts) / sizes
+        daypergb = np.median(daypergb[np.isfinite(daypergb)]) if np.isfinite(daypergb).any() else np.nan
+        missing = ~np.isfinite(tends)
+        tends[missing] = tstarts[missing] + sizes[missing] * daypergb
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            coverage = self.metaantflag.good_durations(tstarts, tends) / (tends - tstarts)
+        unknown = ~np.isfinite(coverage)
+        coverage[unknown] = self.metaantflag.check_goods(tstarts[unknown]).astype(float)
+        coverage = np.clip(coverage, 0., 1.)
+
+        ### calibration rank for the source in each scan
+        scannums = [int(scan.split("/")[0]) for scan in shortscans]
+        try:
+            cracosched = CracoSchedBlock(int(self.calsbid[2:]))
+            ranks = cracosched.get_scans_calib_rank(scannums, mjds=(tstarts + tends) / 2)
+        except Exception as error:
+            log.warning(f"cannot get calibration rank for scans... ignore it... error - {error}")
+            ranks = np.full(len(shortscans), 2, dtype=int)
+        weights = np.array([SCAN_RANK_WEIGHT.get(rank, 0.) for rank in ranks])
+
+        scores = coverage * sizes * weights
+        for scan, cov, size, rank, score in zip(shortscans, coverage, sizes, ranks, scores):
+            log.info(f"scan {scan} - good coverage {cov:.2f}, size {size:.1f}GB, rank {rank}, score {score:.2f}")
+        return scores
+
     def _select_scan(self, random=False):
         if random:
             raise NotImplementedError("random scan not supported...")
+
+        try:
+            scores = self._score_scans()
+            if np.any(scores > 0):
+                iscan = int(np.argmax(scores))
+                print(f"Using scan - {self.allscans[iscan]}")
+                return self.allscans[iscan]
+            log.warning("no usable scan based on the score... use the default one...")
+        except Exception as error:
+            log.warning(f"failed to score scans... use the default one... error - {error}")
         
         if len(self.allscans) > 10:
             print(f"Using scan - {self.allscans[10]}")
@@ -84,9 +154,21 @@ class CalibManager:
         else:
             return self.allscans[0]
 
+    def stream_solution(self, cmd):
+        """
+        wrap the calibration command so that the solution is copied beam by beam while the calibration is running,
+        the streamer starts (and times out) with the calibration job rather than when it is queued,
+        and the copycal job queued after it stops the streamer and finalises the solution (mostly unchanged files by then)
+
+        note - `--stream` goes before `-cal`, so that the on-finish hook does not take it as the copycal job
+        """
+        logpath = f"{cfg.TMPDIR}/copycal.stream.{self.calsbid}.log"
+        log.info(f"streaming calibration solution with the calibration job... log in {logpath}")
+        streamcmd = f"{COPYCAL_PATH} --stream -cal {self.values.calsbid} >> {logpath} 2>&1 < /dev/null &"
+        return f"sh -c {shlex.quote(f'{streamcmd} {cmd}')}"
+
     def copy_solution(self):
-        copycal_path = "/CRACO/SOFTWARE/craco/wan342/Software/craco_run/copycal.py"
-        cpcmd = f"{copycal_path} -cal {self.values.calsbid}"
+        cpcmd = f"{COPYCAL_PATH} -cal {self.values.calsbid}"
 
         environment = {
             "TS_SOCKET": cfg.CAL_RUN_TS_SOCKET,
@@ -102,8 +184,9 @@ class CalibManager:
         )
 
     def run(self):
-        calscan = self._select_scan()
+        ### flag information is needed to select the scan
         self._get_meta()
+        calscan = self._select_scan()
 
         ### try to push it to calibration database
         try:
@@ -119,6 +202,7 @@ class CalibManager:
         except: startmjd = 0
 
         cmd = f"""mpi_run_beam.sh {calscan} `which mpi_do_calibrate.sh` --start-mjd {startmjd}"""
+        if not self.values.dryrun: cmd = self.stream_solution(cmd)
         
         # if self.values.dryrun:
         if self.values.dryrun:
@@ -139,7 +223,7 @@ class CalibManager:
                 text=True, env=ecopy
             )
 
-        self.copy_solution()   
+        self.copy_solution()
 
 def main():
     from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
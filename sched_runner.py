@@ -1,7 +1,13 @@
 #!/usr/bin/env python
 
-from auto_sched import PipeSched
+from auto_sched import PipeSched, install_sched_notify
+
+import logging
+log = logging.getLogger(__name__)
 
 if __name__ == "__main__":
+    try: install_sched_notify()
+    except Exception as error:
+        log.warning(f"cannot install notification triggers - {error}")
     pipesched = PipeSched(dryrun=False)
-    pipesched.run(timethreshold=1.)
\ No newline at end of file
+    pipesched.run(timethreshold=1.)
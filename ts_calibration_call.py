@@ -1,13 +1,17 @@
 #!/usr/bin/env python
+import subprocess
 import sys
 import re
 import os
 
+import numpy as np
+
 from craco.datadirs import CalDir
 
 from craco.craco_run.auto_sched import (
     push_sbid_calibration, 
-    query_table_single_column
+    query_table_single_column,
+    render_calsol_qc,
 )
 from craco.craco_run.slackpost import SlackPostManager
 
@@ -20,13 +24,54 @@ def find_calib_info(runcmd):
 ### update calib_rank in observation table -2 if calibration is not suitable
 # note - perhaps good to implement that in auto_sched, push_sbid_calibration part...
 
+def launch_qc_plot(sbid, calcls, thread_ts=None):
+    """
+    render the quality control plot and upload it to the slack thread in a detached process,
+    so that the calibration queue does not wait for it
+    """
+    qcdir = calcls.caldir.cal_head_dir
+    npzpath = f"{qcdir}/calsol_qc.npz"
+    np.savez(npzpath, phase_diff=calcls.sbid_phase_diff, beams=np.array(calcls.qc_beams))
+    with open(f"{qcdir}/calsol_qc.log", "w") as logfile:
+        subprocess.Popen(
+            [sys.executable, __file__, "--qc-plot", str(sbid), npzpath, thread_ts or ""],
+            stdout=logfile, stderr=subprocess.STDOUT, start_new_session=True,
+        )
+
+def run_qc_plot(sbid, npzpath, thread_ts=None):
+    """render the quality control plot from the phase difference saved by the hook, and upload it"""
+    slackbot = SlackPostManager(test=False)
+    qc_fpath = f"{os.path.dirname(npzpath)}/calsol_qc.png"
+    try:
+        data = np.load(npzpath)
+        render_calsol_qc(data["phase_diff"], data["beams"], qc_fpath)
+        slackbot.upload_file(
+            files=qc_fpath, comment=f"*[CALIB]* quality control plot for SB{sbid}",
+            thread_ts=thread_ts,
+        )
+    except Exception as error:
+        slackbot.post_message(
+            f"*[CALIB]* failed to make quality control plot for SB{sbid} - {error}", 
+            thread_ts=thread_ts,
+        )
+    finally:
+        if os.path.exists(npzpath): os.remove(npzpath)
+
 if __name__ == "__main__":
     args = sys.argv
+    if len(args) >= 2 and args[1] == "--qc-plot":
+        ### detached process launched by the hook below
+        run_qc_plot(int(args[2]), args[3], args[4] if len(args) >= 5 and args[4] else None)
+        sys.exit(0)
+
     runcmd = args[-1]
     sbid = find_calib_info(runcmd)
-    push_sbid_calibration(
+    ### tsp calls it with jobid, error level, output file and command
+    errorlevel = int(args[2]) if len(args) >= 5 else 0
+    ### the quality control plot is rendered in a detached process, the verdict is pushed first
+    calcls = push_sbid_calibration(
         sbid=sbid, prepare=False, 
-        plot=True, updateobs=True
+        plot=False, updateobs=True,
     )
 
     ### add slack here if possible
@@ -34,19 +79,30 @@ if __name__ == "__main__":
     calib_valid = query_table_single_column(sbid, "valid", "calibration")
     calib_nbeam = query_table_single_column(sbid, "solnum", "calibration")
 
-    caldir = CalDir(sbid)
-    qc_fpath = f"{caldir.cal_head_dir}/calsol_qc.png"
-
     slackbot = SlackPostManager(test=False)
     slackmsg = f"*[CALIB]* finish calibration for SB{sbid} - valid status {calib_valid} with status {calib_status}"
     slackmsg += f"\nnumber of solutions -> {calib_nbeam}"
-    if os.path.exists(qc_fpath):
+    if errorlevel != 0:
+        slackmsg += f"\n*calibration copy incomplete* - see {CalDir(sbid).cal_head_dir}/calsol.manifest.json"
+
+    if getattr(calcls, "sbid_phase_diff", None) is not None:
         calib_flagant = query_table_single_column(sbid, "badant", "calibration")
         ngoodant = query_table_single_column(sbid, "goodant", "calibration")
         slackmsg += f"\nbad antennas in calibration - {calib_flagant}"
         slackmsg += f"\nnumber of good antennas - {ngoodant}"
-        slackbot.upload_file(files=qc_fpath, comment=slackmsg)
+        response = slackbot.post_message(slackmsg)
+
+        ### quality control plot will be attached to the thread
+        thread_ts = None
+        if response is not None: thread_ts = slackbot.get_thread_ts_from_response(response)
+        try:
+            launch_qc_plot(sbid, calcls, thread_ts=thread_ts)
+        except Exception as error:
+            slackbot.post_message(
+                f"*[CALIB]* failed to make quality control plot for SB{sbid} - {error}", 
+                thread_ts=thread_ts,
+            )
     else:
         slackbot.post_message(slackmsg + " *no quality contral image found*", mention_team=True)
 
-    # command - /CRACO/SOFTWARE/craco/craftop/softwares/craco_run/copycal.py -cal 63393
\ No newline at end of file
+    # command - /CRACO/SOFTWARE/craco/craftop/softwares/craco_run/copycal.py -cal 63393
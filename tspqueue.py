@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+### helpers for task spooler (tsp) queues - inspect queue status, decide which queue to use and submit jobs
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import subprocess
+import os
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+RUNNING_REMAINING = 0.5 # fraction of work left for a running job, we don't know how long it has been running
+
+def _tsp_env(socket, environment=None):
+    ecopy = os.environ.copy()
+    if environment is not None: ecopy.update(environment)
+    ecopy["TS_SOCKET"] = socket
+    return ecopy
+
+def list_tsp_jobs(socket):
+    """
+    list all jobs in a given tsp queue
+
+    return a list of dictionaries with id, state (queued, running, finished etc.) and tokens (rest of the line)
+    """
+    p = subprocess.run(["tsp"], capture_output=True, text=True, env=_tsp_env(socket))
+    if p.returncode != 0:
+        raise RuntimeError(f"cannot list jobs for queue {socket}... {p.stderr.strip()}")
+
+    jobs = []
+    for line in p.stdout.splitlines()[1:]: # first line is the header
+        fields = line.split()
+        if len(fields) < 2 or not fields[0].isdigit(): continue
+        jobs.append(dict(id=int(fields[0]), state=fields[1], tokens=fields[2:]))
+    return jobs
+
+def get_queue_load(socket, costfunc, default_cost=1., jobs=None):
+    """
+    estimate the remaining work in a given queue
+
+    costfunc: function to estimate the cost of a job based on its tokens, return None if unknown
+    jobs: jobs already listed from `list_tsp_jobs`, the queue is not checked again if provided
+    return the number of unfinished jobs and the estimated remaining cost
+    """
+    if jobs is None: jobs = list_tsp_jobs(socket)
+    njob = 0; load = 0.
+    for job in jobs:
+        if job["state"] not in ("queued", "running", "allocating"): continue
+        try: cost = costfunc(job["tokens"])
+        except Exception: cost = None
+        if cost is None: cost = default_cost
+        if job["state"] == "running": cost *= RUNNING_REMAINING
+        njob += 1; load += cost
+    return njob, load
+
+def plan_queue_placement(costs, loads, offset=0):
+    """
+    greedily assign jobs to queues so that all queues finish at a similar time
+    (longest job first, each goes to the queue with the least load)
+
+    costs: list of costs for each job
+    loads: list of existing loads for each queue
+    offset: queue to start with when several queues have the same load
+
+    return a list of queue indices for each job
+    """
+    nqueues = len(loads)
+    loads = list(loads)
+    placement = [None] * len(costs)
+    for ijob in sorted(range(len(costs)), key=lambda i: -costs[i]):
+        iqueue = min(range(nqueues), key=lambda q: (loads[q], (q - offset) % nqueues))
+        placement[ijob] = iqueue
+        loads[iqueue] += costs[ijob]
+    return placement
+
+def submit_tsp_job(socket, argv, environment=None):
+    """submit a single job (argv list, no shell involved) to a given queue, return the tsp job id"""
+    p = subprocess.run(
+        ["tsp"] + [str(arg) for arg in argv], capture_output=True, 
+        text=True, env=_tsp_env(socket, environment),
+    )
+    if p.returncode != 0:
+        raise RuntimeError(f"failed to submit {argv} to {socket}... {p.stderr.strip()}")
+    return int(p.stdout.strip())
+
+def submit_tsp_jobs(jobs):
+    """
+    submit a batch of jobs, each of them is a dictionary with socket, argv and environment (optional)
+    jobs for the same queue are submitted in order (so they run in order), different queues are submitted concurrently
+
+    jobid (None if failed) and error are filled in for each job, return jobs
+    """
+    queues = {}
+    for job in jobs: queues.setdefault(job["socket"], []).append(job)
+
+    def _submit_queue(queuejobs):
+        for job in queuejobs:
+            try: 
+                job["jobid"] = submit_tsp_job(job["socket"], job["argv"], job.get("environment"))
+                job["error"] = None
+            except Exception as error:
+                job["jobid"] = None; job["error"] = str(error)
+
+    if len(queues) == 0: return jobs
+    with ThreadPoolExecutor(max_workers=len(queues)) as executor:
+        list(executor.map(_submit_queue, queues.values()))
+    return jobs
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+### read the primary header of uvfits files directly - one read per file, cached per (path, mtime, size)
+### and size uvfits files for all scans concurrently
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import threading
+import logging
+import time
+import os
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+FITS_BLOCK = 2880
+FITS_CARD = 80
+
+def _parse_card_value(value):
+    """
+    parse the value part of a card (after "= "), the comment after "/" is dropped
+    return str, bool, int or float
+    """
+    value = value.strip()
+    if value.startswith("'"):
+        ### string value, '' is an escaped quote
+        end = 1
+        while True:
+            end = value.find("'", end)
+            if end < 0: return value[1:].rstrip()
+            if value[end+1:end+2] != "'": break
+            end += 2
+        return value[1:end].replace("''", "'").rstrip()
+
+    value = value.split("/")[0].strip()
+    if value == "T": return True
+    if value == "F": return False
+    try: return int(value)
+    except ValueError: pass
+    try: return float(value.replace("D", "E"))
+    except ValueError: return value
+
+def parse_fits_header(raw):
+    """
+    walk through 80-character cards in raw bytes
+
+    return a dictionary of keywords and whether the END card is found
+    """
+    header = {}
+    for icard in range(0, len(raw) - FITS_CARD + 1, FITS_CARD):
+        card = raw[icard:icard+FITS_CARD].decode("ascii", errors="replace")
+        key = card[:8].strip()
+        if key == "END": return header, True
+        if card[8:10] != "= ": continue # COMMENT, HISTORY or blank cards
+        header[key] = _parse_card_value(card[10:])
+    return header, False
+
+def _read_header(fname, nblock=6):
+    """read the primary header, `nblock` fits blocks at a time, until END card"""
+    raw = b""
+    with open(fname, "rb") as fp:
+        while True:
+            chunk = fp.read(FITS_BLOCK * nblock)
+            if not chunk: break
+            raw += chunk
+            header, complete = parse_fits_header(raw)
+            if complete: return header
+    raise RuntimeError(f"no END card found in the header of {fname}...")
+
+@lru_cache(maxsize=4096)
+def _read_header_cached(fname, mtime, size):
+    return _read_header(fname)
+
+def read_uvfits_header(fname):
+    """
+    read all keywords in the primary header of a uvfits file
+    the header is cached until the file is modified
+    """
+    stat = os.stat(fname)
+    return dict(_read_header_cached(fname, stat.st_mtime_ns, stat.st_size))
+
+def read_uvfits_headers(fnames, nworkers=12):
+    """
+    read headers of a list of uvfits files (e.g., all beams for a scan) concurrently
+
+    return a dictionary of headers, None for files that cannot be read
+    """
+    def _read(fname):
+        try: return read_uvfits_header(fname)
+        except Exception as error:
+            log.warning(f"cannot read uvfits header from {fname}... error - {error}")
+            return None
+
+    fnames = list(fnames)
+    if len(fnames) == 0: return {}
+    with ThreadPoolExecutor(max_workers=min(nworkers, len(fnames))) as executor:
+        headers = list(executor.map(_read, fnames))
+    return dict(zip(fnames, headers))
+
+def uvfits_mjd_start(header):
+    """start mjd of the observation, based on PZERO4 (in jd)"""
+    if "PZERO4" not in header:
+        raise RuntimeError("no PZERO4 found in the uvfits header...")
+    mjd_start = float(header["PZERO4"]) - 2400000.5
+    if 50000 < mjd_start < 80000:
+        return mjd_start
+    raise RuntimeError(f"I found a really unexpected value of MJD start from the UVfits header - {mjd_start}")
+
+def uvfits_nchan(header):
+    """number of channels, based on NAXIS4"""
+    if "NAXIS4" not in header:
+        raise RuntimeError("no NAXIS4 found in the uvfits header...")
+    nchan = int(header["NAXIS4"])
+    if nchan < 300: return nchan
+    raise RuntimeError(f"I found a really unexpected value of nchan from uvfits header - {nchan}")
+
+_STAT_CACHE = {}
+_STAT_LOCK = threading.Lock()
+
+def stat_uvfits(fnames, nworkers=16, ttl=60.):
+    """
+    stat a list of files concurrently (they are on different NFS mounts normally)
+    results are cached per path for `ttl` seconds, as the mtime only comes with a new stat
+
+    return a dictionary of (size in bytes, mtime in ns), None for files that do not exist
+    """
+    def _stat(fname):
+        now = time.time()
+        with _STAT_LOCK: cached = _STAT_CACHE.get(fname)
+        if cached is not None and now - cached[0] < ttl: return cached[1]
+        try: 
+            stat = os.stat(fname)
+            result = (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            result = None
+        with _STAT_LOCK: _STAT_CACHE[fname] = (now, result)
+        return result
+
+    fnames = list(fnames)
+    if len(fnames) == 0: return {}
+    with ThreadPoolExecutor(max_workers=min(nworkers, len(fnames))) as executor:
+        stats = list(executor.map(_stat, fnames))
+    return dict(zip(fnames, stats))
+
+def _scan_uvfits_paths(sbid, scan):
+    from craco.datadirs import ScanDir
+    return ScanDir(sbid=sbid, scan=scan).uvfits_paths
+
+def _resolve_scan_paths(sbid, scans, nworkers=16):
+    """uvfits paths for all scans concurrently, return a list of (scan, paths, error)"""
+    def _paths(scan):
+        try: return scan, _scan_uvfits_paths(sbid, scan), None
+        except Exception as error: return scan, [], error
+
+    with ThreadPoolExecutor(max_workers=min(nworkers, len(scans))) as executor:
+        return list(executor.map(_paths, scans))
+
+def scan_first_uvfits(sbid, scans, nworkers=16):
+    """
+    find the first existing uvfits file (in the order of beams) for each scan,
+    beams are only stat-ed until one is found, normally just one file per scan
+
+    return a dictionary of (path, size in GB) for each scan, None if no uvfits file is found
+    """
+    scans = list(scans)
+    if len(scans) == 0: return {}
+    pending = {scan: paths for scan, paths, _ in _resolve_scan_paths(sbid, scans, nworkers=nworkers) if paths}
+    first = {scan: None for scan in scans}
+    ibeam = 0
+    while pending:
+        stats = stat_uvfits([paths[ibeam] for paths in pending.values()], nworkers=nworkers)
+        for scan, paths in list(pending.items()):
+            stat = stats[paths[ibeam]]
+            if stat is not None:
+                first[scan] = (paths[ibeam], stat[0] / 1024 ** 3)
+            if stat is not None or ibeam + 1 >= len(paths): del pending[scan]
+        ibeam += 1
+    return first
+
+def scan_uvfits_summary(sbid, scans, nbeam=36, nworkers=16):
+    """
+    size all beams of all scans for a given sbid in one go
+
+    scans: list of scans in the format of ??/??????????????
+    return a dictionary of summary for each scan - 
+        paths (existing uvfits files in the order of beams), sizes (in GB), 
+        nbeam (number of existing beams), total_size, min_size (in GB), 
+        complete (whether all beams exist), error (if uvfits files cannot be located)
+    """
+    scans = list(scans)
+    if len(scans) == 0: return {}
+    scanpaths = _resolve_scan_paths(sbid, scans, nworkers=nworkers)
+    stats = stat_uvfits([path for _, paths, _ in scanpaths for path in paths], nworkers=nworkers)
+
+    summary = {}
+    for scan, paths, error in scanpaths:
+        existing = [path for path in paths if stats.get(path) is not None]
+        sizes = [stats[path][0] / 1024 ** 3 for path in existing]
+        summary[scan] = dict(
+            paths=existing, sizes=sizes, nbeam=len(existing),
+            total_size=sum(sizes), min_size=min(sizes) if sizes else 0.,
+            complete=len(existing) >= nbeam, error=error,
+        )
+    return summary